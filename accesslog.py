@@ -0,0 +1,105 @@
+'''Structured access log of the commands.
+
+Each command is logged as a JSON object on a line, w/ its request id,
+action, instance, status and timings.  The records are put on a queue
+by the command's thread, and formatted and written by a separate
+thread, so commands never wait on the log's file.
+
+Only a fraction, samplerate, of the successful commands are logged, the
+failed ones always are.  Check enabled before building a record, so
+that nothing is built for the commands that are not logged.'''
+
+from logging.handlers import QueueHandler, QueueListener
+
+import io
+import json
+import logging
+import queue
+import random
+import unittest
+
+class _JSONFormatter(logging.Formatter):
+	def format(self, record):
+		return json.dumps(dict(time=record.created, **record.access),
+		    sort_keys=True)
+
+class AccessLog(object):
+	def __init__(self, handler, samplerate=1.0, name='openc2.access'):
+		'''Log to the logging.Handler handler, through the logger
+		name.'''
+
+		self.samplerate = samplerate
+
+		self._logger = logging.getLogger(name)
+		self._logger.propagate = False
+		self._logger.setLevel(logging.INFO)
+
+		handler.setFormatter(_JSONFormatter())
+		self._qhandler = QueueHandler(queue.SimpleQueue())
+		self._listener = QueueListener(self._qhandler.queue, handler)
+
+	def start(self):
+		self._logger.addHandler(self._qhandler)
+		self._listener.start()
+
+	def stop(self):
+		'''Stop logging, after writing the queued records.'''
+
+		self._logger.removeHandler(self._qhandler)
+		self._listener.stop()
+
+	def enabled(self, status=200):
+		'''Return if a command that returned status is to be logged.'''
+
+		if not self._logger.isEnabledFor(logging.INFO):
+			return False
+
+		return status >= 400 or self.samplerate >= 1 or \
+		    random.random() < self.samplerate
+
+	def log(self, **fields):
+		'''Log a record of fields, which must be JSON serializable.'''
+
+		self._logger.info('access', extra={ 'access': fields })
+
+class AccessLogTest(unittest.TestCase):
+	def setUp(self):
+		self.out = io.StringIO()
+		self.al = AccessLog(logging.StreamHandler(self.out),
+		    name='openc2.test.access')
+		self.al.start()
+
+	def tearDown(self):
+		self.al._logger.setLevel(logging.INFO)
+
+	def records(self):
+		self.al.stop()
+		return [ json.loads(x) for x in self.out.getvalue().splitlines() ]
+
+	def test_log(self):
+		# That a record
+		self.assertTrue(self.al.enabled())
+		self.al.log(request_id='a', status=200, duration=.5)
+
+		# is written as JSON w/ the time
+		recs = self.records()
+		self.assertEqual(len(recs), 1)
+		self.assertIn('time', recs[0])
+		del recs[0]['time']
+		self.assertEqual(recs[0], { 'request_id': 'a', 'status': 200,
+		    'duration': .5 })
+
+	def test_sampling(self):
+		self.al.samplerate = 0
+
+		# That successes are not logged when sampled out
+		self.assertFalse(self.al.enabled(200))
+
+		# and that failures are
+		self.assertTrue(self.al.enabled(400))
+
+		# That when the level is disabled
+		self.al._logger.setLevel(logging.WARNING)
+
+		# that nothing is logged
+		self.assertFalse(self.al.enabled(400))
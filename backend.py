@@ -1,5 +1,6 @@
 from flask import (
-	Flask, Response, render_template, request, g, abort, make_response
+	Flask, Response, render_template, request, g, abort, make_response,
+	stream_with_context, jsonify
 )
 from mock import patch, MagicMock
 
@@ -9,12 +10,29 @@ from libcloud.compute.base import NodeImage, NodeSize, Node
 from libcloud.compute.types import Provider
 from libcloud.compute.providers import get_driver
 
+import concurrent.futures
 import itertools
 import json
-import traceback
+import os
+import threading
+import time
 
 from frontend import _seropenc2, _deseropenc2, _instcmds
-from frontend import CREATE, START, STOP, DELETE, NewContextAWS
+from frontend import _oc2format, _oc2mimetype
+from frontend import CREATE, START, STOP, DELETE, SET, NewContextAWS
+from sharedstore import LocalStore, SharedStore, NameIter
+from poller import StatePoller
+from journal import Journal
+from driverpool import DriverPool
+from cloudreplay import Recorder, Replayer
+from accesslog import AccessLog
+from inventory import iterinventory, iterstates, geninventory, getnode
+from inventory import InventorySnapshot, keyed, LEFTOUT
+from reconcile import reconcile
+from standby import StandbyPool
+from imagecatalog import ImageCatalog, ec2lookup
+from pubsub import CMDTOPIC, RSPTOPIC, devicetopic, mkenvelope, parseenvelope
+from pubsub import parsebroker
 
 app = Flask(__name__)
 
@@ -31,6 +49,9 @@ if True:
 	driverkwargs = dict(project='openc2-cloud-261123', region='us-west-1')
 	createnodekwargs = dict(location='us-central1-a', size='f1-micro')
 	# freebsd-12-0-release-amd64
+	listimageskwargs = dict(ex_project=[ driverkwargs['project'],
+	    'freebsd-org-cloud-dev' ])
+	imagelookup = None
 else:
 	# EC2
 	access_key, secret_key = open('.keys').read().split()
@@ -40,25 +61,108 @@ else:
 	sizeobj = MagicMock()
 	sizeobj.id = 't2.nano'
 	createnodekwargs = dict(size=sizeobj)
+	# the public images are too many to list, they are looked up
+	# by id
+	listimageskwargs = dict(ex_owner='self')
+	imagelookup = ec2lookup
 
-def genresp(oc2resp, command_id):
-	'''Generate a response from a Response.'''
+# When running multiple backend processes, set this to the path of a
+# SQLite database so that they share the instance name counter and the
+# inventory cache.
+sharedstorepath = os.environ.get('OPENC2_SHARED_STORE')
+
+# Seconds a fleet listing may be reused to answer queries, 0 disables.
+inventoryttl = float(os.environ.get('OPENC2_INVENTORY_TTL', '0'))
+
+if sharedstorepath:
+	store = SharedStore(sharedstorepath)
+else:
+	store = LocalStore()
+
+# Directory to journal the commands and their responses to, see
+# journal.py.
+journaldir = os.environ.get('OPENC2_JOURNAL')
+
+if journaldir:
+	journal = Journal(journaldir)
+else:
+	journal = None
+
+# Seconds the listing of the images that can be created is used before
+# it is listed again.
+imagettl = float(os.environ.get('OPENC2_IMAGE_TTL', '600'))
+images = ImageCatalog(imagettl, lookup=imagelookup, **listimageskwargs)
+
+# To log each command as JSON, set OPENC2_ACCESS_LOG to a file, or to -
+# for stderr, and OPENC2_ACCESS_SAMPLE to the fraction of the successful
+# commands to log.  See accesslog.py.
+accesslogpath = os.environ.get('OPENC2_ACCESS_LOG')
+
+if accesslogpath:
+	accesslog = AccessLog(logging.StreamHandler() if accesslogpath ==
+	    '-' else logging.FileHandler(accesslogpath),
+	    float(os.environ.get('OPENC2_ACCESS_SAMPLE', '1')))
+	accesslog.start()
+else:
+	accesslog = None
+
+# To record the traffic w/ the cloud provider to a file, set
+# OPENC2_RECORD to its path.  To answer from such a recording instead of
+# the provider, set OPENC2_REPLAY, and OPENC2_REPLAY_TIMESCALE to scale
+# the recorded latencies (0 for none).  See cloudreplay.py.
+if os.environ.get('OPENC2_RECORD'):
+	Recorder(os.environ['OPENC2_RECORD']).start()
+elif os.environ.get('OPENC2_REPLAY'):
+	Replayer(os.environ['OPENC2_REPLAY'],
+	    float(os.environ.get('OPENC2_REPLAY_TIMESCALE', '1'))).start()
+
+# Seconds between fleet listings while commands wait for a state, and
+# the longest a command will wait.
+pollinterval = 2
+waitmax = 300
+
+# Seconds a command may take, a client may ask for less w/ the
+# X-Command-Timeout header.  A command that takes longer is abandoned,
+# and a 408 response returned.  The driver calls of the commands run
+# on cmdworkers threads, the waits for a state in the request's.
+cmdtimeout = float(os.environ.get('OPENC2_COMMAND_TIMEOUT', str(waitmax)))
+cmdworkers = 32
+
+# Seconds past the deadline to wait for a command, so that one that
+# ends at the deadline returns its response instead of timing out.
+deadlinegrace = 1
+
+# Seconds a single request to the cloud provider may take, so that an
+# abandoned command does not hold its thread forever.
+drivertimeout = 60
+driverkwargs['timeout'] = drivertimeout
+
+cmdexecutor = concurrent.futures.ThreadPoolExecutor(cmdworkers,
+    thread_name_prefix='command')
+
+def genresp(oc2resp, command_id, fmt='json'):
+	'''Generate a response from a Response, encoded in fmt.'''
+
+	if fmt == 'json':
+		# be explicit about encoding, the automatic encoding is undocumented
+		body = _seropenc2(oc2resp).encode('utf-8')
+	else:
+		body = _seropenc2(oc2resp, fmt)
 
-	# be explicit about encoding, the automatic encoding is undocumented
-	body = _seropenc2(oc2resp).encode('utf-8')
 	r = Response(response=body, status=oc2resp.status,
 	    headers={ 'X-Request-ID': command_id },
-	    mimetype='application/openc2-rsp+json;version=1.0')
+	    mimetype=_oc2mimetype('rsp', fmt))
 
 	return r
 
 class CommandFailure(Exception):
 	status_code = 400
 
-	def __init__(self, cmd, msg, command_id, status_code=None):
+	def __init__(self, cmd, msg, command_id, status_code=None, fmt='json'):
 		self.cmd = cmd
 		self.msg = msg
 		self.command_id = command_id
+		self.fmt = fmt
 		if status_code is not None:
 			self.status_code = status_code
 
@@ -66,14 +170,25 @@ class CommandFailure(Exception):
 def handle_commandfailure(err):
 	resp = OpenC2Response(status=err.status_code, status_text=err.msg)
 
-	return genresp(resp, err.command_id)
+	return genresp(resp, err.command_id, err.fmt)
+
+nameiter = NameIter(store, 'openc2test-%d')
+
+@app.route('/health')
+@app.route('/ec2/health')
+def healthroute():
+	'''Used by the frontend to check that the actuator is up, at
+	health under the actuator's URL.'''
 
-nameiter = ('openc2test-%d' % i for i in itertools.count(1))
+	resp = make_response(b'ok')
+	resp.mimetype = 'text/plain'
+
+	return resp
 
 @app.route('/', methods=['GET', 'POST'])
 @app.route('/ec2', methods=['GET', 'POST'])
 def ec2route():
-	app.logger.debug('received msg: %s' % repr(request.data))
+	app.logger.debug('received msg: %r', request.data)
 	try:
 		cmdid = request.headers['X-Request-ID']
 	except KeyError:
@@ -82,84 +197,493 @@ def ec2route():
 		resp.mimetype = 'text/plain'
 		return resp
 
-	req = _deseropenc2(request.data)
+	# JSON unless the client asks for one of the binary encodings
+	reqfmt = _oc2format(request.headers.get('Content-Type', ''))
+	respfmt = _oc2format(request.headers.get('Accept', ''))
+
+	try:
+		req = _deseropenc2(request.data, reqfmt)
+	except Exception as e:
+		# e.g. a selector or instance name that is not a valid key
+		raise CommandFailure(None, 'invalid command: %s' % e, cmdid,
+		    fmt=respfmt)
+
+	timeout = cmdtimeout
+	if 'X-Command-Timeout' in request.headers:
+		try:
+			timeout = min(timeout,
+			    float(request.headers['X-Command-Timeout']))
+		except ValueError:
+			raise CommandFailure(req, 'invalid X-Command-Timeout',
+			    cmdid, fmt=respfmt)
+
+	if respfmt == 'json' and req.action == 'query' and \
+	    'instance' not in req.target:
+		return streaminventory(req, cmdid, timeout)
+
+	resp = runcommand(request.method, req, cmdid, respfmt, timeout)
+
+	if app.logger.isEnabledFor(logging.DEBUG):
+		app.logger.debug('replied msg: %r', _seropenc2(resp))
+
+	if respfmt == 'json':
+		resp = make_response(_seropenc2(resp))
+	else:
+		resp = make_response(_seropenc2(resp, respfmt))
+		resp.mimetype = _oc2mimetype('rsp', respfmt)
+
+	# Copy over the command id from the request
+	resp.headers['X-Request-ID'] = request.headers['X-Request-ID']
+
+	return resp
+
+def streaminventory(req, cmdid, timeout=None):
+	'''Respond to a query of the whole fleet.  The response is
+	generated while the fleet is listed, so neither the nodes nor the
+	response are held in memory all at once.
+
+	As the status is sent before the listing is done, a failure part
+	way through ends the response early, making it invalid JSON.  The
+	command is journaled and logged when the response ends, w/ a 500
+	status if it ended early, or a 408 if the listing was not done
+	within timeout seconds (cmdtimeout by default).  There is no
+	instance to wait for.'''
+
+	if timeout is None:
+		timeout = cmdtimeout
+	method = request.method
+	start = time.time()
+	submitted = time.monotonic()
+	deadline = submitted + timeout
+	timing = { 'started': submitted }
+
+	def done(status, text):
+		_journalcmd(method, req, cmdid, OpenC2Response(status=status,
+		    status_text=text), start)
+		_logcmd(req, cmdid, status, submitted, timing)
+
+	def bounded(states):
+		# the listing runs in this thread, so the deadline is
+		# checked between the nodes
+		for i in states:
+			if time.monotonic() >= deadline:
+				raise TimeoutError('deadline exceeded')
+			yield i
+
+	try:
+		if 'wait' in req.target:
+			raise CommandFailure(req,
+			    'wait needs a single instance', cmdid)
+
+		states = bounded(iterstates(get_clouddriver(),
+		    req.target.get('selector')))
+
+		# an empty inventory is not valid, so know if there is
+		# one before sending the status
+		try:
+			first = next(states)
+		except StopIteration:
+			raise CommandFailure(req, 'no instances matched', cmdid,
+			    404)
+		except TimeoutError:
+			raise CommandFailure(req, 'deadline exceeded', cmdid,
+			    408)
+	except CommandFailure as e:
+		done(e.status_code, e.msg)
+		raise
+	except Exception as e:
+		app.logger.debug('generic failure: %r', e, exc_info=True)
+		done(400, repr(e))
+		raise CommandFailure(req, repr(e), cmdid)
+
+	def generate():
+		status, text = 500, 'response ended early'
+		try:
+			for i in geninventory(itertools.chain([ first ],
+			    states)):
+				yield i
+			status, text = 200, 'streamed'
+		except TimeoutError as e:
+			status, text = 408, str(e)
+			raise
+		except Exception as e:
+			text = repr(e)
+			raise
+		finally:
+			done(status, text)
+
+	return Response(stream_with_context(generate()),
+	    status=200,
+	    headers={ 'X-Request-ID': cmdid },
+	    mimetype=_oc2mimetype('rsp'))
+
+def runcommand(method, req, cmdid, respfmt='json', timeout=None):
+	'''Run the OpenC2 Command req, as received w/ the HTTP method
+	(GET or POST).  Returns the OpenC2 Response, or raises
+	CommandFailure, w/ a status of 408 if the command did not finish
+	within timeout seconds (cmdtimeout by default).'''
+
+	if timeout is None:
+		timeout = cmdtimeout
+	submitted = time.monotonic()
+	deadline = submitted + timeout
+	timing = {}
+
+	start = time.time()
+	try:
+		if 'wait' in req.target and (req.action == SET or 'selector'
+		    in req.target or ('instance' not in req.target and
+		    req.action != CREATE)):
+			raise CommandFailure(req,
+			    'wait needs a single instance', cmdid, fmt=respfmt)
+
+		fut = cmdexecutor.submit(_rundeadline, method, req, cmdid,
+		    respfmt, deadline, timing)
+		try:
+			status, res, ncawsargs, inst = fut.result(max(0,
+			    deadline - time.monotonic()) + deadlinegrace)
+		except concurrent.futures.TimeoutError:
+			# The thread can not be stopped: it stays busy until
+			# its driver call returns, at most drivertimeout
+			# seconds, only this thread stops waiting on it.  A
+			# command not yet started never is.
+			fut.cancel()
+			raise CommandFailure(req, 'deadline exceeded', cmdid,
+			    408, respfmt)
+
+		if 'wait' in req.target:
+			# In this thread, so that the command's thread is
+			# only held by the driver calls.  Block until the
+			# instance reaches the requested state, 102
+			# (processing) says that it has not yet.
+			res = poller.wait(inst, req.target['wait'],
+			    min(time.monotonic() + waitmax, deadline))
+			if res != req.target['wait']:
+				status = 102
+			if res is None:
+				# not listed in time
+				res = 'state unknown'
+
+		try:
+			if ncawsargs:
+				kwargs = dict(results=NewContextAWS(**ncawsargs))
+			else:
+				kwargs = {}
+			resp = OpenC2Response(status=status, status_text=res,
+			    **kwargs)
+		except Exception as e:
+			app.logger.debug('invalid response: %r', e,
+			    exc_info=True)
+			raise CommandFailure(req, repr(e), cmdid, fmt=respfmt)
+	except CommandFailure as e:
+		_journalcmd(method, req, cmdid, OpenC2Response(
+		    status=e.status_code, status_text=e.msg), start)
+		_logcmd(req, cmdid, e.status_code, submitted, timing)
+		raise
+
+	_journalcmd(method, req, cmdid, resp, start)
+	_logcmd(req, cmdid, resp.status, submitted, timing)
+
+	return resp
+
+def _logcmd(req, cmdid, status, submitted, timing):
+	if accesslog is None or not accesslog.enabled(status):
+		return
+
+	# queued is the time waiting for a thread
+	now = time.monotonic()
+	accesslog.log(request_id=cmdid, action=req.action,
+	    instance=req.target.get('instance'), status=status,
+	    queued=timing.get('started', now) - submitted,
+	    duration=now - submitted)
+
+def _journalcmd(method, req, cmdid, resp, start):
+	if journal is None:
+		return
+
+	try:
+		journal.append(dict(request_id=cmdid, method=method,
+		    command=_seropenc2(req), response=_seropenc2(resp),
+		    time=start, duration=time.time() - start))
+	except OSError as e:
+		# the command was run, so its response is still returned
+		app.logger.error('unable to journal %s: %r', cmdid, e)
+
+def _rundeadline(method, req, cmdid, respfmt, deadline, timing):
+	timing['started'] = time.monotonic()
+	if timing['started'] >= deadline:
+		# waited too long for a thread
+		raise CommandFailure(req, 'deadline exceeded', cmdid, 408,
+		    respfmt)
+
+	with app.app_context():
+		return _runcommand(method, req, cmdid, respfmt)
+
+def _runcommand(method, req, cmdid, respfmt):
+	# Returns the status, status text and results of the command,
+	# and the instance it is for, if any.
 	ncawsargs = {}
 	status = 200
+	inst = None
 	clddrv = get_clouddriver()
 	try:
 		if hasattr(req.target, 'instance'):
 			inst = req.target.instance
-		if request.method == 'POST' and req.action == CREATE:
+		if method == 'POST' and req.action == CREATE:
 			ami = req.target['image']
-			img = MagicMock()
-			img.id = ami
 			try:
 				inst = req.target.instance
 			except AttributeError:
-				inst = next(nameiter)
-			r = clddrv.create_node(image=img,
-			    name=inst, **createnodekwargs)
-			inst = r.name
-			app.logger.debug('started ami %s, instance id: %s' % (ami, inst))
+				# an unnamed instance can be a standby one
+				inst = standby.claim(ami) if standby else None
+				if inst is None:
+					inst = _createnode(clddrv, ami,
+					    next(nameiter)).name
+			else:
+				inst = _createnode(clddrv, ami, inst).name
+			store.invalidate('inventory')
+			app.logger.debug('started ami %s, instance id: %s', ami, inst)
 
 			res = inst
 			ncawsargs['instance'] = inst
-		elif request.method == 'POST' and req.action == START:
+		elif method == 'POST' and req.action in _selectstates and \
+		    'selector' in req.target:
+			# the filtering is done by the provider, and the
+			# action run on each instance in parallel
+			inv = InventorySnapshot(iterinventory(clddrv,
+			    req.target['selector']), clddrv)
+			state = _selectstates[req.action]
+
+			report, skipped = keyed(reconcile(inv, { x: state for x
+			    in inv }, driverpool, None).items())
+			store.invalidate('inventory')
+
+			res, status = _keyedresult(ncawsargs, 'report', report,
+			    skipped)
+		elif method == 'POST' and req.action == START:
 			get_node(inst).start()
+			store.invalidate('inventory')
 
 			res = ''
-		elif request.method == 'POST' and req.action == STOP:
+		elif method == 'POST' and req.action == STOP:
 			if not get_node(inst).stop_node():
 				raise RuntimeError(
 				    'unable to stop instance: %s' % repr(inst))
+			store.invalidate('inventory')
 
 			res = ''
-		elif request.method == 'POST' and req.action == DELETE:
+		elif method == 'POST' and req.action == DELETE:
 			get_node(inst).destroy()
+			store.invalidate('inventory')
 
 			res = ''
-		elif request.method in ('GET', 'POST') and req.action == 'query':
-			insts = [ x for x in clddrv.list_nodes() if
-			    x.name == inst ]
+		elif method == 'POST' and req.action == SET:
+			# one listing, and only the operations needed
+			ami = req.target.get('image')
+			def create(drv, name):
+				if ami is None:
+					raise ValueError('no image to create from')
+				_createnode(drv, ami, name)
+
+			ncawsargs['report'] = reconcile(
+			    InventorySnapshot.fromdriver(clddrv),
+			    req.target['desired'], driverpool, create)
+			store.invalidate('inventory')
 
-			if insts:
-				res = str(insts[0].state)
-			else:
+			res = ''
+		elif method in ('GET', 'POST') and req.action == 'query' and \
+		    'instance' not in req.target:
+			# the whole fleet, or the selected instances, when
+			# not streamed
+			inv, skipped = keyed(iterstates(clddrv,
+			    req.target.get('selector')))
+
+			res, status = _keyedresult(ncawsargs, 'inventory', inv,
+			    skipped)
+		elif method in ('GET', 'POST') and req.action == 'query':
+			res = get_state(inst)
+
+			if res is None:
 				res = 'instance not found'
 				status = 404
 		else:
 			raise Exception('unhandled request')
 	except Exception as e:
-		app.logger.debug('generic failure: %s' % repr(e))
-		app.logger.debug(traceback.format_exc())
-		raise CommandFailure(req, repr(e), cmdid)
+		app.logger.debug('generic failure: %r', e, exc_info=True)
+		raise CommandFailure(req, repr(e), cmdid, fmt=respfmt)
 
-	if ncawsargs:
-		kwargs = dict(results=NewContextAWS(**ncawsargs))
-	else:
-		kwargs = {}
-	resp = OpenC2Response(status=status, status_text=res, **kwargs)
+	return status, res, ncawsargs, inst
 
-	app.logger.debug('replied msg: %s' % repr(_seropenc2(resp)))
+def _keyedresult(ncawsargs, name, d, skipped):
+	# Set the result name to the dict d, from keyed, and return the
+	# status text and status.  An empty dict is not a valid result.
+	if not d:
+		return (LEFTOUT % skipped if skipped else
+		    'no instances matched'), 404
 
-	resp = make_response(_seropenc2(resp))
+	ncawsargs[name] = d
 
-	# Copy over the command id from the request
-	resp.headers['X-Request-ID'] = request.headers['X-Request-ID']
+	return (LEFTOUT % skipped if skipped else ''), 200
 
-	return resp
+# action: the state an action w/ a selector brings the instances to
+_selectstates = {
+	START: 'running',
+	STOP: 'stopped',
+	DELETE: 'deleted',
+}
+
+def _createnode(drv, ami, name):
+	return drv.create_node(image=images.resolve(drv, ami), name=name,
+	    **createnodekwargs)
+
+def serve_pubsub(broker, devid=None):
+	'''Run the commands published to broker, and publish the
+	responses.  Queries sent to every actuator are run, and when devid
+	is set, all the commands sent to just this actuator.'''
+
+	def run(cmdid, body, fmt, shared):
+		with app.app_context():
+			try:
+				req = _deseropenc2(body, fmt)
+				if shared and req.action != 'query':
+					# every actuator gets it, it would
+					# be run by each of them
+					raise CommandFailure(req,
+					    'only queries can be sent to '
+					    'every actuator', cmdid, fmt=fmt)
+
+				# there are no methods, allow every action
+				resp = runcommand('POST', req, cmdid, fmt)
+			except CommandFailure as e:
+				resp = OpenC2Response(status=e.status_code,
+				    status_text=e.msg)
+			except Exception as e:
+				resp = OpenC2Response(status=400,
+				    status_text=repr(e))
+
+		broker.publish(RSPTOPIC, mkenvelope(cmdid,
+		    _seropenc2(resp, fmt), fmt, devid))
+
+	def mkhandler(shared):
+		def handlecmd(topic, payload):
+			cmdid, body, fmt = parseenvelope(payload)
+
+			# Not on the broker's thread, which delivers no
+			# messages while it is busy.  Like an HTTP request,
+			# each command gets a thread that waits on it.
+			threading.Thread(target=run, args=(cmdid, body, fmt,
+			    shared), name='pubsubcmd', daemon=True).start()
+
+		return handlecmd
+
+	broker.subscribe(CMDTOPIC, mkhandler(True))
+	if devid is not None:
+		broker.subscribe(devicetopic(devid), mkhandler(False))
+
+# To also take commands from an MQTT broker, set to host[:port].
+if os.environ.get('OPENC2_MQTT_BROKER'):
+	serve_pubsub(parsebroker(os.environ['OPENC2_MQTT_BROKER']),
+	    os.environ.get('OPENC2_DEVICE_ID'))
 
 def get_node(instname):
-	return [ x for x in get_clouddriver().list_nodes() if
-	    x.name == instname ][0]
+	'''Return the Node of the instance instname, w/o listing the
+	fleet when the provider can get a single node.'''
+
+	return getnode(get_clouddriver(), instname)
+
+def get_state(instname):
+	'''Return the state of the instance instname, or None if there is
+	no such instance.  The cached listing is used when there is one.'''
+
+	inv = store.getbuilt('inventory', InventorySnapshot) if \
+	    inventoryttl else None
+	if inv is not None:
+		return inv.get(instname)
+
+	try:
+		return str(get_node(instname).state)
+	except KeyError:
+		return None
+
+def get_inventory():
+	'''Return an InventorySnapshot of the fleet.  When inventoryttl is
+	set, the listing is cached in the store, and shared w/ the other
+	backend processes.  Each process builds the snapshot of a cached
+	listing once.'''
+
+	inv = store.getbuilt('inventory', InventorySnapshot) if \
+	    inventoryttl else None
+	if inv is not None:
+		return inv.withdriver(get_clouddriver())
+
+	inv = InventorySnapshot.fromdriver(get_clouddriver())
+	if inventoryttl:
+		store.set('inventory', list(inv.entries()), inventoryttl)
+
+	return inv
+
+def _pollinventory():
+	# a waiter needs the current states, not the cached listing
+	with app.app_context():
+		return InventorySnapshot.fromdriver(get_clouddriver())
+
+poller = StatePoller(_pollinventory, pollinterval)
+
+def _newdriver():
+	cls = get_driver(provider)
+
+	return cls(*driverargs, **driverkwargs)
+
+# Drivers are created and authenticated ahead of time, and the OAuth
+# token is refreshed in the background, so commands do not wait on
+# either.  Set OPENC2_WARMUP=0 to only create drivers when needed.
+driverpool = DriverPool(_newdriver, size=4)
+if os.environ.get('OPENC2_WARMUP', '1') != '0':
+	driverpool.start()
 
 def get_clouddriver():
 	if not hasattr(g, 'driver'):
-		cls = get_driver(provider)
-		g.driver = cls(*driverargs, **driverkwargs)
+		g.driver = driverpool.get()
 
 	return g.driver
 
+@app.teardown_appcontext
+def _putclouddriver(exc):
+	drv = g.pop('driver', None)
+	if drv is not None:
+		driverpool.put(drv)
+
+@app.route('/driverstatus')
+def driverstatusroute():
+	'''The state of the driver pool, including the token age and
+	when it expires.'''
+
+	return jsonify(driverpool.stats())
+
+# Stopped instances kept ready for each of the images, comma separated,
+# in OPENC2_STANDBY_IMAGES, so that a create w/o an instance name only
+# has to start one.  OPENC2_STANDBY_SIZE is the instances per image.
+standbyimages = [ x for x in os.environ.get('OPENC2_STANDBY_IMAGES',
+    '').split(',') if x ]
+standbysize = int(os.environ.get('OPENC2_STANDBY_SIZE', '2'))
+
+if standbyimages:
+	standby = StandbyPool(driverpool, _createnode,
+	    NameIter(store, 'openc2standby-%d'), standbyimages, standbysize)
+	standby.start()
+else:
+	standby = None
+
+@app.route('/standbystatus')
+def standbystatusroute():
+	'''The ready standby instances, and the hit rate and latency of
+	the claims.'''
+
+	if standby is None:
+		return jsonify({})
+
+	return jsonify(standby.stats())
+
 import unittest
 from libcloud.compute.drivers.dummy import DummyNodeDriver
 from libcloud.compute.base import Node
@@ -199,13 +723,18 @@ class BetterDummyNodeDriver(DummyNodeDriver):
 		node.state = NodeState.RUNNING
 		return True
 
-def _selfpatch(name):
-	return patch('%s.%s' % (__name__, name))
+def _selfpatch(name, *args):
+	return patch('%s.%s' % (__name__, name), *args)
 
 class BackendTests(unittest.TestCase):
 	def setUp(self):
 		self.test_client = app.test_client(self)
 
+		# the images of the test drivers
+		p = _selfpatch('images', ImageCatalog())
+		p.start()
+		self.addCleanup(p.stop)
+
 	def test_genresp(self):
 		res = 'soijef'
 		cmdid = 'weoiudf'
@@ -234,6 +763,39 @@ class BackendTests(unittest.TestCase):
 		# has the passed status code
 		self.assertEqual(r.status_code, 200)
 
+	def test_genrespfmt(self):
+		cmdid = 'weoiudf'
+
+		resp = OpenC2Response(status=200, status_text='running')
+
+		# that a response generated as msgpack
+		r = genresp(resp, cmdid, 'msgpack')
+
+		# has the msgpack mime-type
+		self.assertEqual(r.content_type,
+		    'application/openc2-rsp+msgpack;version=1.0')
+
+		# and decodes to the response
+		self.assertEqual(_deseropenc2(r.data, 'msgpack').status_text,
+		    'running')
+
+	def test_invalidcmd(self):
+		cmduuid = 'someuuid'
+
+		# That a command w/ a selector key that is too short
+		response = self.test_client.post('/ec2', data=json.dumps({
+		    'action': 'stop', 'target': { 'x-newcontext-com:aws': {
+		    'selector': { 'os': 'linux' } } } }),
+		    headers={ 'X-Request-ID': cmduuid })
+
+		# is rejected
+		self.assertEqual(response.status_code, 400)
+		self.assertTrue(_deseropenc2(response.data).status_text
+		    .startswith('invalid command: '))
+
+		# w/ the request id
+		self.assertEqual(response.headers['X-Request-ID'], cmduuid)
+
 	def test_cmdfailure(self):
 		cmduuid = 'weoiud'
 		ami = 'owiejp'
@@ -270,6 +832,7 @@ class BackendTests(unittest.TestCase):
 		# has the correct status code
 		self.assertEqual(r.status_code, 500)
 
+	@_selfpatch('driverpool', DriverPool(_newdriver))
 	@_selfpatch('get_driver')
 	@_selfpatch('open')
 	def test_getclouddriver(self, op, drvmock):
@@ -292,6 +855,39 @@ class BackendTests(unittest.TestCase):
 			# that a second call returns the same object
 			self.assertIs(get_clouddriver(), drvmock()())
 
+		drvmock().reset_mock()
+
+		# That when the request is done, the driver is reused
+		with app.app_context():
+			drv = get_clouddriver()
+			drvmock().assert_not_called()
+			self.assertIs(drv, drvmock()())
+
+	def test_driverstatus(self):
+		with _selfpatch('driverpool') as dp:
+			dp.stats.return_value = dict(token_age=5)
+
+			# That the driver status
+			response = self.test_client.get('/driverstatus')
+
+			# is successful
+			self.assertEqual(response.status_code, 200)
+
+			# and returns the stats
+			self.assertEqual(response.get_json(), dict(token_age=5))
+
+	def test_health(self):
+		# That the health check
+		response = self.test_client.get('/health')
+
+		# is successful
+		self.assertEqual(response.status_code, 200)
+		self.assertEqual(response.data, b'ok')
+
+		# and is also under the /ec2 URL
+		response = self.test_client.get('/ec2/health')
+		self.assertEqual(response.status_code, 200)
+
 	def test_nocmdid(self):
 		# That a request w/o a command id
 		response = self.test_client.post('/ec2', data='bogus')
@@ -442,6 +1038,600 @@ class BackendTests(unittest.TestCase):
 		# that it fails
 		self.assertEqual(response.status_code, 400)
 
+	@_selfpatch('inventoryttl', 60)
+	@_selfpatch('store', LocalStore())
+	@_selfpatch('get_clouddriver')
+	def test_inventory(self, drvmock):
+		dnd = BetterDummyNodeDriver(1)
+		drvmock.return_value = dnd
+		node = dnd.list_nodes()[0]
+
+		with patch.object(dnd, 'list_nodes', wraps=dnd.list_nodes) as ln:
+			# That the inventory maps names to states
+			self.assertEqual(get_inventory(),
+			    { node.name: str(node.state) })
+
+			# and that a second call is served from the cache
+			get_inventory()
+			ln.assert_called_once_with()
+
+			# w/o building the snapshot again
+			self.assertIs(get_inventory()._names,
+			    get_inventory()._names)
+			self.assertEqual(get_state(node.name), str(node.state))
+			ln.assert_called_once_with()
+
+			# but once invalidated
+			store.invalidate('inventory')
+
+			# that the nodes are listed again
+			get_inventory()
+			self.assertEqual(ln.call_count, 2)
+
+			# That the poller
+			states = _pollinventory()
+
+			# always lists the nodes
+			self.assertEqual(ln.call_count, 3)
+			self.assertEqual(states, { node.name: str(node.state) })
+
+	@_selfpatch('get_clouddriver')
+	def test_queryfmt(self, drvmock):
+		cmduuid = 'someuuid'
+
+		dnd = BetterDummyNodeDriver(1)
+		drvmock.return_value = dnd
+		node = dnd.list_nodes()[0]
+
+		cmd = Command(action='query',
+		    target=NewContextAWS(instance=node.name))
+
+		# That a query sent as cbor asking for a cbor response
+		response = self.test_client.get('/ec2',
+		    data=_seropenc2(cmd, 'cbor'), headers={
+			'X-Request-ID': cmduuid,
+			'Content-Type': _oc2mimetype('cmd', 'cbor'),
+			'Accept': _oc2mimetype('rsp', 'cbor'),
+		    })
+
+		# Is successful
+		self.assertEqual(response.status_code, 200)
+
+		# and is cbor
+		self.assertEqual(response.content_type,
+		    'application/openc2-rsp+cbor;version=1.0')
+
+		# and matches the node state
+		dcmd = _deseropenc2(response.data, 'cbor')
+		self.assertEqual(dcmd.status_text, node.state)
+
+	@_selfpatch('get_clouddriver')
+	def test_pubsub(self, drvmock):
+		from pubsub import LocalBroker
+		import queue
+
+		cmduuid = 'someuuid'
+
+		dnd = BetterDummyNodeDriver(1)
+		drvmock.return_value = dnd
+		node = dnd.list_nodes()[0]
+
+		broker = LocalBroker()
+		resps = queue.Queue()
+		broker.subscribe(RSPTOPIC, lambda t, p: resps.put(p))
+
+		# That when serving commands from a broker
+		serve_pubsub(broker, 'actuator')
+
+		# and a query is published to the device
+		cmd = Command(action='query',
+		    target=NewContextAWS(instance=node.name))
+		broker.publish(devicetopic('actuator'),
+		    mkenvelope(cmduuid, _seropenc2(cmd)))
+
+		# that a response is published
+		# w/ the request id
+		rcmdid, body, fmt = parseenvelope(resps.get(timeout=5))
+		self.assertEqual(rcmdid, cmduuid)
+
+		# and the node state
+		dcmd = _deseropenc2(body, fmt)
+		self.assertEqual(dcmd.status_text, node.state)
+
+		# That a stop sent to every actuator
+		cmd = Command(action=STOP,
+		    target=NewContextAWS(instance=node.name))
+		broker.publish(CMDTOPIC, mkenvelope(cmduuid, _seropenc2(cmd)))
+
+		# is rejected
+		rcmdid, body, fmt = parseenvelope(resps.get(timeout=5))
+		self.assertEqual(json.loads(body), { 'status': 400,
+		    'status_text': 'only queries can be sent to every actuator' })
+
+		# and not run
+		self.assertEqual(node.state, NodeState.RUNNING)
+
+		# That a stop sent to the device
+		broker.publish(devicetopic('actuator'),
+		    mkenvelope(cmduuid, _seropenc2(cmd)))
+
+		# is run
+		rcmdid, body, fmt = parseenvelope(resps.get(timeout=5))
+		self.assertEqual(node.state, NodeState.STOPPED)
+
+	@_selfpatch('get_clouddriver')
+	def test_journal(self, drvmock):
+		import tempfile
+		from journal import replay
+
+		cmduuid = 'someuuid'
+
+		dnd = BetterDummyNodeDriver(1)
+		drvmock.return_value = dnd
+		node = dnd.list_nodes()[0]
+
+		cmd = Command(action='query',
+		    target=NewContextAWS(instance=node.name))
+
+		with tempfile.TemporaryDirectory() as tmpdir, \
+		    _selfpatch('journal', Journal(tmpdir)):
+			# That when a command is run w/ a journal
+			response = self.test_client.get('/ec2',
+			    data=_seropenc2(cmd),
+			    headers={ 'X-Request-ID': cmduuid })
+
+			journal.close()
+
+			# that it is journaled
+			ent, = replay(tmpdir)
+
+			# w/ the request id, command and response
+			self.assertEqual(ent['request_id'], cmduuid)
+			self.assertEqual(ent['method'], 'GET')
+			self.assertEqual(ent['command'], _seropenc2(cmd))
+			self.assertEqual(ent['response'],
+			    response.data.decode('utf-8'))
+
+	@_selfpatch('get_clouddriver')
+	def test_queryinventory(self, drvmock):
+		cmduuid = 'someuuid'
+
+		dnd = BetterDummyNodeDriver(2)
+		drvmock.return_value = dnd
+		states = { x.name: x.state for x in dnd.list_nodes() }
+
+		cmd = Command(action='query', target=NewContextAWS())
+
+		# That a query of the whole fleet
+		response = self.test_client.get('/ec2', data=_seropenc2(cmd),
+		    headers={ 'X-Request-ID': cmduuid })
+
+		# Is successful
+		self.assertEqual(response.status_code, 200)
+
+		# and is streamed
+		self.assertTrue(response.is_streamed)
+
+		# and has the same command id
+		self.assertEqual(response.headers['X-Request-ID'], cmduuid)
+
+		# and returns the state of each node
+		dcmd = _deseropenc2(response.data)
+		self.assertEqual(dcmd.status, 200)
+		self.assertEqual(dcmd.results['inventory'], states)
+
+		# That when asked for as msgpack
+		response = self.test_client.get('/ec2', data=_seropenc2(cmd),
+		    headers={ 'X-Request-ID': cmduuid,
+		    'Accept': _oc2mimetype('rsp', 'msgpack') })
+
+		# that the same results are returned
+		dcmd = _deseropenc2(response.data, 'msgpack')
+		self.assertEqual(dcmd.results['inventory'], states)
+
+		# That a query of an empty fleet
+		dnd.nl = []
+		response = self.test_client.get('/ec2', data=_seropenc2(cmd),
+		    headers={ 'X-Request-ID': cmduuid })
+
+		# is not found
+		self.assertEqual(response.status_code, 404)
+		self.assertEqual(_deseropenc2(response.data).status, 404)
+
+	@_selfpatch('journal')
+	@_selfpatch('get_clouddriver')
+	def test_streamjournal(self, drvmock, jmock):
+		cmduuid = 'someuuid'
+
+		dnd = BetterDummyNodeDriver(2)
+		drvmock.return_value = dnd
+
+		cmd = Command(action='query', target=NewContextAWS())
+
+		# That a streamed query
+		response = self.test_client.get('/ec2', data=_seropenc2(cmd),
+		    headers={ 'X-Request-ID': cmduuid }, buffered=False)
+
+		# is not journaled before the response is done
+		jmock.append.assert_not_called()
+
+		response.get_data()
+		response.close()
+
+		# but is once it is, as successful
+		ent = jmock.append.call_args[0][0]
+		self.assertEqual(ent['request_id'], cmduuid)
+		self.assertEqual(_deseropenc2(ent['response']).status, 200)
+
+		# That when the listing fails part way
+		def states(*args):
+			yield 'openc2test-1', 'running'
+			raise RuntimeError('listing failed')
+
+		jmock.reset_mock()
+		with _selfpatch('iterstates', states):
+			response = self.test_client.get('/ec2',
+			    data=_seropenc2(cmd),
+			    headers={ 'X-Request-ID': cmduuid }, buffered=False)
+			self.assertRaises(RuntimeError, response.get_data)
+
+		# that it is journaled as failed
+		resp = _deseropenc2(jmock.append.call_args[0][0]['response'])
+		self.assertEqual(resp.status, 500)
+		self.assertEqual(resp.status_text,
+		    "RuntimeError('listing failed')")
+
+		# That when the listing is slower than the timeout
+		def states(*args):
+			yield 'openc2test-1', 'running'
+			time.sleep(.2)
+			yield 'openc2test-2', 'running'
+
+		jmock.reset_mock()
+		with _selfpatch('iterstates', states):
+			response = self.test_client.get('/ec2',
+			    data=_seropenc2(cmd),
+			    headers={ 'X-Request-ID': cmduuid,
+			    'X-Command-Timeout': '.1' }, buffered=False)
+			self.assertRaises(TimeoutError, response.get_data)
+
+		# that it ends, and is journaled w/ a timeout status
+		resp = _deseropenc2(jmock.append.call_args[0][0]['response'])
+		self.assertEqual(resp.status, 408)
+		self.assertEqual(resp.status_text, 'deadline exceeded')
+
+		# That a wait on the whole fleet
+		cmd = Command(action='query',
+		    target=NewContextAWS(wait='running'))
+		jmock.reset_mock()
+		response = self.test_client.get('/ec2', data=_seropenc2(cmd),
+		    headers={ 'X-Request-ID': cmduuid })
+
+		# is rejected
+		self.assertEqual(response.status_code, 400)
+		self.assertEqual(_deseropenc2(response.data).status_text,
+		    'wait needs a single instance')
+
+		# and journaled
+		resp = _deseropenc2(jmock.append.call_args[0][0]['response'])
+		self.assertEqual(resp.status, 400)
+
+	@_selfpatch('get_clouddriver')
+	def test_accesslog(self, drvmock):
+		import io
+
+		cmduuid = 'someuuid'
+
+		dnd = BetterDummyNodeDriver(1)
+		drvmock.return_value = dnd
+		node = dnd.list_nodes()[0]
+
+		out = io.StringIO()
+		al = AccessLog(logging.StreamHandler(out),
+		    name='openc2.test.backend')
+		al.start()
+
+		cmd = Command(action='query',
+		    target=NewContextAWS(instance=node.name))
+
+		# That when a command is run w/ an access log
+		with _selfpatch('accesslog', al):
+			runcommand('GET', cmd, cmduuid)
+
+			# and one fails
+			cmd = Command(action='query',
+			    target=NewContextAWS(instance='bogus'))
+			runcommand('GET', cmd, 'otheruuid')
+		al.stop()
+
+		recs = [ json.loads(x) for x in out.getvalue().splitlines() ]
+
+		# that they are logged
+		self.assertEqual([ (x['request_id'], x['action'],
+		    x['instance'], x['status']) for x in recs ], [
+		    (cmduuid, 'query', node.name, 200),
+		    ('otheruuid', 'query', 'bogus', 404) ])
+
+		# w/ the timings
+		self.assertGreaterEqual(recs[0]['duration'], recs[0]['queued'])
+
+	@_selfpatch('driverpool')
+	@_selfpatch('get_clouddriver')
+	def test_reconcile(self, drvmock, dpmock):
+		cmduuid = 'someuuid'
+
+		dnd = BetterDummyNodeDriver(2)
+		drvmock.return_value = dnd
+		dpmock.get.return_value = dnd
+		a, b = dnd.list_nodes()
+
+		cmd = Command(action=SET, target=NewContextAWS(
+		    image='Ubuntu 9.10', desired={ a.name: 'stopped',
+		    b.name: 'running', 'new': 'running' }))
+
+		# That a reconcile
+		with patch.object(dnd, 'list_nodes',
+		    wraps=dnd.list_nodes) as ln:
+			resp = runcommand('POST', cmd, cmduuid)
+
+			# lists the fleet once, and once more to find the
+			# node to stop, as the dummy driver has no direct
+			# lookup
+			self.assertEqual(ln.call_count, 2)
+
+		# and reports what was done
+		self.assertEqual(resp.status, 200)
+		self.assertEqual(dict(resp.results['report']), {
+		    a.name: 'stopped', b.name: 'unchanged',
+		    'new': 'created' })
+
+		# and did it
+		self.assertEqual(a.state, NodeState.STOPPED)
+		self.assertIn('new', [ x.name for x in dnd.list_nodes() ])
+
+		# That w/o an image, creating fails
+		cmd = Command(action=SET, target=NewContextAWS(
+		    desired={ 'other': 'running' }))
+		resp = runcommand('POST', cmd, cmduuid)
+		self.assertTrue(resp.results['report']['other'].startswith(
+		    'failed: '))
+
+	@_selfpatch('driverpool')
+	@_selfpatch('get_clouddriver')
+	def test_selector(self, drvmock, dpmock):
+		cmduuid = 'someuuid'
+
+		dnd = BetterDummyNodeDriver(3)
+		drvmock.return_value = dnd
+		dpmock.get.return_value = dnd
+		nodes = dnd.list_nodes()
+		for i in (nodes[0], nodes[2]):
+			i.extra['labels'] = { 'quarantine': 'true' }
+
+		selector = { 'quarantine': 'true' }
+
+		# That a stop w/ a selector
+		cmd = Command(action=STOP,
+		    target=NewContextAWS(selector=selector))
+		resp = runcommand('POST', cmd, cmduuid)
+
+		# stops only the selected instances
+		self.assertEqual([ x.state for x in nodes ], [
+		    NodeState.STOPPED, NodeState.RUNNING, NodeState.STOPPED ])
+
+		# and reports them
+		self.assertEqual(dict(resp.results['report']), {
+		    nodes[0].name: 'stopped', nodes[2].name: 'stopped' })
+
+		# That a query w/ a selector
+		cmd = Command(action='query',
+		    target=NewContextAWS(selector=selector))
+		resp = runcommand('GET', cmd, cmduuid)
+
+		# returns the selected instances
+		self.assertEqual(dict(resp.results['inventory']), {
+		    nodes[0].name: 'stopped', nodes[2].name: 'stopped' })
+
+		# That a selector that matches nothing
+		cmd = Command(action=STOP,
+		    target=NewContextAWS(selector={ 'bogus': 'true' }))
+		resp = runcommand('POST', cmd, cmduuid)
+
+		# is not found
+		self.assertEqual((resp.status, resp.status_text),
+		    (404, 'no instances matched'))
+		self.assertNotIn('results', resp)
+
+		# and the same for a query
+		cmd = Command(action='query',
+		    target=NewContextAWS(selector={ 'bogus': 'true' }))
+		resp = runcommand('GET', cmd, cmduuid)
+		self.assertEqual(resp.status, 404)
+
+		# That instances whose names can not be keys
+		nodes[1].name = 'a.b'
+		nodes[1].extra['labels'] = selector
+
+		# are left out, and counted
+		resp = runcommand('GET', Command(action='query',
+		    target=NewContextAWS(selector=selector)), cmduuid)
+		self.assertEqual(dict(resp.results['inventory']), {
+		    nodes[0].name: 'stopped', nodes[2].name: 'stopped' })
+		self.assertEqual(resp.status_text,
+		    '1 instances w/ invalid names left out')
+
+		# That when the response can not be built
+		cmd = Command(action='query',
+		    target=NewContextAWS(selector=selector))
+		with _selfpatch('NewContextAWS') as ncaws:
+			ncaws.side_effect = ValueError('bad results')
+
+			# that the command fails w/ the error
+			with self.assertRaises(CommandFailure) as cm:
+				runcommand('GET', cmd, cmduuid)
+
+		self.assertEqual(cm.exception.msg,
+		    "ValueError('bad results')")
+
+		# That a wait w/ a selector
+		cmd = Command(action=START,
+		    target=NewContextAWS(selector=selector, wait='running'))
+
+		# is rejected
+		with self.assertRaises(CommandFailure) as cm:
+			runcommand('POST', cmd, cmduuid)
+
+		self.assertEqual(cm.exception.status_code, 400)
+		self.assertEqual(cm.exception.msg,
+		    'wait needs a single instance')
+
+		# and nothing was started
+		self.assertEqual(nodes[0].state, NodeState.STOPPED)
+
+		# That a terminated instance that matches a selector
+		dnd.nl.append(Node(id='term', name='terminated-1',
+		    state=NodeState.TERMINATED, public_ips=[], private_ips=[],
+		    driver=dnd, extra={ 'labels': selector }))
+
+		with patch.object(dnd, 'create_node') as cn:
+			resp = runcommand('POST', Command(action=START,
+			    target=NewContextAWS(selector=selector)), cmduuid)
+
+		# is not found
+		self.assertEqual(resp.results['report']['terminated-1'],
+		    'not found')
+
+		# and is not created
+		cn.assert_not_called()
+
+	@_selfpatch('nameiter')
+	@_selfpatch('get_clouddriver')
+	def test_createstandby(self, drvmock, nameiter):
+		cmduuid = 'someuuid'
+
+		dnd = BetterDummyNodeDriver(0)
+		drvmock.return_value = dnd
+		nameiter.__next__.return_value = 'created'
+
+		pool = MagicMock()
+		pool.get.return_value = dnd
+		sp = StandbyPool(pool, _createnode, iter([ 'standby-1' ]),
+		    [ 'Ubuntu 9.10' ], size=1)
+		sp.fill()
+
+		cmd = Command(action=CREATE,
+		    target=NewContextAWS(image='Ubuntu 9.10'))
+
+		with _selfpatch('standby', sp):
+			# That a create of a standby image
+			resp = runcommand('POST', cmd, cmduuid)
+
+			# claims and starts the standby instance
+			self.assertEqual(resp.results['instance'], 'standby-1')
+			self.assertEqual(getnode(dnd, 'standby-1').state,
+			    NodeState.RUNNING)
+
+			# and that when there are none left
+			resp = runcommand('POST', cmd, cmduuid)
+
+			# that one is created
+			self.assertEqual(resp.results['instance'], 'created')
+
+			# and that the claims are reported
+			stats = json.loads(self.test_client.get(
+			    '/standbystatus').data)
+			self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+
+		# That w/o a standby pool nothing is reported
+		self.assertEqual(json.loads(self.test_client.get(
+		    '/standbystatus').data), {})
+
+	@_selfpatch('get_clouddriver')
+	def test_createimage(self, drvmock):
+		cmduuid = 'someuuid'
+
+		dnd = BetterDummyNodeDriver(0)
+		drvmock.return_value = dnd
+
+		with patch.object(dnd, 'list_images',
+		    wraps=dnd.list_images) as li, \
+		    patch.object(dnd, 'create_node',
+		    wraps=dnd.create_node) as cn:
+			# That a create of an unknown image
+			cmd = Command(action=CREATE, target=NewContextAWS(
+			    image='bogus', instance='a'))
+
+			# fails
+			self.assertRaises(CommandFailure, runcommand, 'POST',
+			    cmd, cmduuid)
+
+			# w/o trying to create it
+			cn.assert_not_called()
+
+			# That creates of an image
+			for i in ('b', 'c'):
+				cmd = Command(action=CREATE, target=NewContextAWS(
+				    image='Ubuntu 9.10', instance=i))
+				runcommand('POST', cmd, cmduuid)
+
+			# are passed the image
+			self.assertEqual(cn.call_args[1]['image'].name,
+			    'Ubuntu 9.10')
+
+			# and that the images were listed once
+			li.assert_called_once_with()
+
+	@_selfpatch('deadlinegrace', 0)
+	@_selfpatch('poller')
+	@_selfpatch('get_clouddriver')
+	def test_deadline(self, drvmock, pollmock):
+		import threading
+
+		cmduuid = 'someuuid'
+
+		dnd = BetterDummyNodeDriver(1)
+		drvmock.return_value = dnd
+		node = dnd.list_nodes()[0]
+
+		cmd = Command(action=STOP,
+		    target=NewContextAWS(instance=node.name))
+
+		# That when the provider hangs
+		hung = threading.Event()
+		with patch.object(dnd, 'list_nodes') as ln:
+			ln.side_effect = lambda: hung.wait(5)
+
+			# that the command times out
+			with self.assertRaises(CommandFailure) as cm:
+				runcommand('POST', cmd, cmduuid, timeout=.1)
+
+			hung.set()
+
+		# w/ a timeout status
+		self.assertEqual(cm.exception.status_code, 408)
+
+		# and the command id
+		self.assertEqual(cm.exception.command_id, cmduuid)
+
+		# That a wait is limited by the deadline
+		cmd = Command(action=START,
+		    target=NewContextAWS(instance=node.name, wait='running'))
+		pollmock.wait.return_value = 'running'
+
+		waiters = []
+		def wait(*args):
+			waiters.append(threading.current_thread())
+			return 'running'
+		pollmock.wait.side_effect = wait
+
+		start = time.monotonic()
+		resp = runcommand('POST', cmd, cmduuid, timeout=5)
+		self.assertEqual(resp.status, 200)
+		self.assertLess(pollmock.wait.call_args[0][2], start + 6)
+
+		# and does not hold a command thread
+		self.assertEqual(waiters, [ threading.current_thread() ])
+
 	@_selfpatch('get_clouddriver')
 	def test_start(self, drvmock):
 		cmduuid = 'someuuid'
@@ -481,6 +1671,50 @@ class BackendTests(unittest.TestCase):
 		# that it fails
 		self.assertEqual(response.status_code, 400)
 
+	@_selfpatch('poller')
+	@_selfpatch('get_clouddriver')
+	def test_startwait(self, drvmock, pollmock):
+		cmduuid = 'someuuid'
+
+		dnd = BetterDummyNodeDriver(1)
+		drvmock.return_value = dnd
+
+		instid = dnd.list_nodes()[0].name
+		dnd.list_nodes()[0].stop_node()
+
+		cmd = Command(action=START,
+		    target=NewContextAWS(instance=instid, wait='running'))
+
+		# That when the instance reaches the state
+		pollmock.wait.return_value = 'running'
+
+		# a request to start an instance and wait
+		response = self.test_client.post('/ec2', data=_seropenc2(cmd),
+		    headers={ 'X-Request-ID': cmduuid })
+
+		# Is successful
+		self.assertEqual(response.status_code, 200)
+
+		# and waited on the poller for the instance
+		self.assertEqual(pollmock.wait.call_args[0][:2],
+		    (instid, 'running'))
+
+		# and returns the state
+		dcmd = _deseropenc2(response.data)
+		self.assertEqual(dcmd.status, 200)
+		self.assertEqual(dcmd.status_text, 'running')
+
+		# That when the state is not reached in time
+		pollmock.wait.return_value = 'pending'
+
+		response = self.test_client.post('/ec2', data=_seropenc2(cmd),
+		    headers={ 'X-Request-ID': cmduuid })
+
+		# that it returns processing and the current state
+		dcmd = _deseropenc2(response.data)
+		self.assertEqual(dcmd.status, 102)
+		self.assertEqual(dcmd.status_text, 'pending')
+
 	@_selfpatch('get_clouddriver')
 	def test_stop(self, drvmock):
 		cmduuid = 'someuuid'
@@ -0,0 +1,236 @@
+'''Benchmarks for the actuator.
+
+Run all of them w/:
+	python bench.py
+
+or only some by name:
+	python bench.py codecs
+'''
+
+import json
+import sys
+import time
+import timeit
+import tracemalloc
+
+def _fleetresp(n):
+	# The structure of a response covering n instances
+	return {
+		'status': 200,
+		'results': { 'x-newcontext-com:aws': {
+			'inventory': { 'openc2test-%d' % i: 'running' for i in
+			    range(n) },
+		} },
+	}
+
+def bench_codecs(sizes=(10, 1000, 100000)):
+	'''Encode/decode time and size of a response in each message
+	encoding, including the conversion from/to the OpenC2 objects.'''
+
+	from frontend import _codecs, _seropenc2, _deseropenc2
+	from frontend import NewContextAWS
+	from openc2 import Response
+
+	print('%-8s %8s %12s %12s %12s' % ('format', 'nodes', 'bytes',
+	    'encode ms', 'decode ms'))
+	for n in sizes:
+		msg = Response(status=200, results=NewContextAWS(
+		    inventory=_fleetresp(n)['results']['x-newcontext-com:aws'][
+		    'inventory']))
+		reps = max(1, 10000 // n)
+		for fmt in sorted(_codecs):
+			data = _seropenc2(msg, fmt)
+			enctime = timeit.timeit(lambda: _seropenc2(msg, fmt),
+			    number=reps)
+			dectime = timeit.timeit(lambda: _deseropenc2(data, fmt),
+			    number=reps)
+
+			print('%-8s %8d %12d %12.3f %12.3f' % (fmt, n, len(data),
+			    enctime * 1000 / reps, dectime * 1000 / reps))
+
+def _peakmem(fun):
+	'''Return the peak memory allocated while running fun, and the time
+	fun took.'''
+
+	tracemalloc.start()
+	start = time.perf_counter()
+	fun()
+	elapsed = time.perf_counter() - start
+	peak = tracemalloc.get_traced_memory()[1]
+	tracemalloc.stop()
+
+	return peak, elapsed
+
+def bench_stream(sizes=(1000, 10000, 100000, 500000)):
+	'''Peak memory and time to first byte of a fleet query response,
+	built as one string vs. streamed w/ geninventory.'''
+
+	from inventory import geninventory
+
+	def states(n):
+		return (('openc2test-%d' % i, 'running') for i in range(n))
+
+	def whole(n):
+		body = json.dumps(_fleetresp(n)).encode('utf-8')
+		first.append(time.perf_counter())
+
+	def streamed(n):
+		for i in geninventory(states(n)):
+			if len(first) == 1:
+				first.append(time.perf_counter())
+			i.encode('utf-8')
+
+	print('%-8s %8s %12s %12s %12s' % ('method', 'nodes', 'peak KiB',
+	    'ttfb ms', 'total ms'))
+	for n in sizes:
+		for name, fun in (('whole', whole), ('streamed', streamed)):
+			first = [ time.perf_counter() ]
+			peak, elapsed = _peakmem(lambda: fun(n))
+			print('%-8s %8d %12d %12.3f %12.3f' % (name, n,
+			    peak // 1024, (first[1] - first[0]) * 1000,
+			    elapsed * 1000))
+
+def _mknodes(n):
+	# Nodes like the ones list_nodes returns
+	from libcloud.compute.base import Node, NodeImage, NodeSize
+	from libcloud.compute.types import NodeState
+
+	size = NodeSize(id='f1-micro', name='f1-micro', ram=614, disk=10,
+	    bandwidth=None, price=0.0, driver=None)
+
+	return [ Node(id=str(1000000 + i), name='openc2test-%d' % i,
+	    state=NodeState.RUNNING, public_ips=[ '10.0.%d.%d' % (i // 256 %
+	    256, i % 256) ], private_ips=[ '192.168.%d.%d' % (i // 256 % 256,
+	    i % 256) ], driver=None, size=size,
+	    image=NodeImage(id='img-%d' % i, name='freebsd-12-0', driver=None),
+	    extra={ 'zone': 'us-central1-a', 'status': 'RUNNING',
+	    'machineType': 'f1-micro', 'tags': [], 'labels': {},
+	    'metadata': {}, 'selfLink': 'https://compute/openc2test-%d' % i,
+	    'creationTimestamp': '2020-01-29T00:00:00.000-08:00' })
+	    for i in range(n) ]
+
+def bench_inventory(sizes=(1000, 10000, 100000)):
+	'''Memory held by a fleet listing kept as Nodes vs. as an
+	InventorySnapshot, and the time to look up a state.'''
+
+	from inventory import InventorySnapshot
+
+	print('%-9s %8s %12s %12s' % ('kind', 'nodes', 'KiB', 'lookup us'))
+	for n in sizes:
+		tracemalloc.start()
+		nodes = _mknodes(n)
+		nodesmem = tracemalloc.get_traced_memory()[0]
+		tracemalloc.stop()
+
+		byname = { x.name: x for x in nodes }
+		entries = [ (x.name, x.id, str(x.state)) for x in nodes ]
+		del nodes
+
+		tracemalloc.start()
+		snap = InventorySnapshot(entries)
+		snapmem = tracemalloc.get_traced_memory()[0]
+		tracemalloc.stop()
+		del entries
+
+		name = 'openc2test-%d' % (n // 2)
+		reps = 10000
+		nodetime = timeit.timeit(lambda: byname[name].state, number=reps)
+		snaptime = timeit.timeit(lambda: snap[name], number=reps)
+
+		print('%-9s %8d %12d %12.3f' % ('nodes', n, nodesmem // 1024,
+		    nodetime * 1e6 / reps))
+		print('%-9s %8d %12d %12.3f' % ('snapshot', n, snapmem // 1024,
+		    snaptime * 1e6 / reps))
+
+def bench_getnode(sizes=(100, 1000, 10000, 100000)):
+	'''Time to get one node by listing the fleet vs. w/ getnode, from
+	a simulated GCE provider whose responses have to be decoded.'''
+
+	from libcloud.compute.types import NodeState, Provider
+	from mock import MagicMock
+	from inventory import getnode, iterinventory
+
+	print('%-8s %8s %12s' % ('method', 'nodes', 'ms'))
+	for n in sizes:
+		insts = [ { 'name': 'openc2test-%d' % i, 'id': i,
+		    'status': 'RUNNING' } for i in range(n) ]
+		listing = json.dumps({ 'items': { 'zones/a': {
+		    'instances': insts } } })
+		byname = { x['name']: json.dumps({ 'items': { 'zones/a': {
+		    'instances': [ x ] } } }) for x in insts }
+
+		def request(path, method):
+			params = drv.connection.gce_params
+			r = MagicMock()
+			if 'filter' in params:
+				r.object = json.loads(byname[
+				    params['filter'].split('"')[1]])
+			else:
+				r.object = json.loads(listing)
+			return r
+
+		drv = MagicMock()
+		drv.type = Provider.GCE
+		drv.NODE_STATE_MAP = { 'RUNNING': NodeState.RUNNING }
+		drv._to_node = lambda x: x
+		drv.connection.request.side_effect = request
+
+		name = 'openc2test-%d' % (n // 2)
+		reps = max(1, 10000 // n)
+		listtime = timeit.timeit(lambda: [ x for x in
+		    iterinventory(drv) if x[0] == name ], number=reps)
+		gettime = timeit.timeit(lambda: getnode(drv, name), number=100)
+
+		print('%-8s %8d %12.3f' % ('list', n, listtime * 1000 / reps))
+		print('%-8s %8d %12.3f' % ('getnode', n, gettime * 1000 / 100))
+
+def bench_replay(reps=10):
+	'''Time the fleet listing and a single node lookup w/ the real
+	driver, against the recording in OPENC2_REPLAY (see
+	cloudreplay.py).'''
+
+	import os
+
+	if not os.environ.get('OPENC2_REPLAY'):
+		print('set OPENC2_REPLAY to a recording to run')
+		return
+
+	os.environ.setdefault('OPENC2_WARMUP', '0')
+	import backend
+
+	with backend.app.app_context():
+		start = time.perf_counter()
+		drv = backend.get_clouddriver()
+		print('%-12s %12.3f' % ('driver ms', (time.perf_counter() -
+		    start) * 1000))
+
+		inv = None
+		start = time.perf_counter()
+		for i in range(reps):
+			inv = backend.InventorySnapshot.fromdriver(drv)
+		print('%-12s %12.3f (%d nodes)' % ('listing ms',
+		    (time.perf_counter() - start) * 1000 / reps, len(inv)))
+
+		if inv:
+			name = next(iter(inv))
+			start = time.perf_counter()
+			for i in range(reps):
+				backend.get_node(name)
+			print('%-12s %12.3f' % ('node ms', (time.perf_counter() -
+			    start) * 1000 / reps))
+
+_benches = {
+	'codecs': bench_codecs,
+	'getnode': bench_getnode,
+	'inventory': bench_inventory,
+	'replay': bench_replay,
+	'stream': bench_stream,
+}
+
+def main(args):
+	for i in args or sorted(_benches):
+		print('== %s' % i)
+		_benches[i]()
+
+if __name__ == '__main__':
+	main(sys.argv[1:])
@@ -0,0 +1,235 @@
+'''Record and replay the HTTP traffic of the libcloud drivers.
+
+A Recorder saves every request a driver makes, w/ the response's
+status, headers, body and how long it took, to a file (one JSON object
+per line).  A Replayer answers the drivers' requests from such a file
+instead of the network, so the real drivers, including their parsing
+of the responses, can be run and benchmarked offline.  The responses
+are delayed by the recorded time multiplied by timescale.
+
+Requests are matched by method and URL, ignoring the query parameters
+in ignoreparams (signatures, timestamps, etc).  When a request was
+recorded more than once, the responses are replayed in order, and the
+last one repeats.
+
+Only the requests made w/ LibcloudConnection.request, which are all the
+requests of the compute drivers, are covered.  The request bodies and
+headers are not recorded, and access tokens in responses are redacted,
+so recordings do not contain credentials.'''
+
+from libcloud.http import LibcloudConnection
+from mock import patch
+
+import base64
+import json
+import requests
+import tempfile
+import threading
+import time
+import unittest
+import urllib.parse
+
+IGNOREPARAMS = frozenset([ 'Signature', 'SignatureMethod',
+    'SignatureVersion', 'Timestamp', 'Expires', 'AWSAccessKeyId',
+    'X-Amz-Date', 'X-Amz-Signature', 'X-Amz-Credential',
+    'X-Amz-Security-Token', 'X-Amz-SignedHeaders', 'X-Amz-Algorithm' ])
+
+_REDACT = ('access_token', 'id_token', 'refresh_token')
+
+def _key(method, url, ignoreparams):
+	parts = urllib.parse.urlsplit(url)
+	query = sorted((k, v) for k, v in urllib.parse.parse_qsl(parts.query,
+	    keep_blank_values=True) if k not in ignoreparams)
+
+	return '%s %s://%s%s?%s' % (method.upper(), parts.scheme, parts.netloc,
+	    parts.path, urllib.parse.urlencode(query))
+
+def _redact(body):
+	try:
+		obj = json.loads(body)
+	except ValueError:
+		return body
+
+	if not isinstance(obj, dict) or not any(x in obj for x in _REDACT):
+		return body
+
+	for i in _REDACT:
+		if i in obj:
+			obj[i] = 'REDACTED'
+
+	return json.dumps(obj).encode('utf-8')
+
+class _Patcher(object):
+	def __enter__(self):
+		self._patch = patch.object(LibcloudConnection, 'request',
+		    self._mkrequest(LibcloudConnection.request))
+		self._patch.start()
+
+		return self
+
+	def __exit__(self, *args):
+		self._patch.stop()
+
+	start = __enter__
+
+	def stop(self):
+		self.__exit__()
+
+class Recorder(_Patcher):
+	'''Record the libcloud traffic while active (as a context manager,
+	or between start and stop) to the file path.  Recordings are
+	appended.'''
+
+	def __init__(self, path, ignoreparams=IGNOREPARAMS):
+		self._path = path
+		self._ignoreparams = ignoreparams
+		self._lock = threading.Lock()
+
+	def _mkrequest(self, orig):
+		recorder = self
+
+		def request(self, method, url, *args, **kwargs):
+			start = time.perf_counter()
+			orig(self, method, url, *args, **kwargs)
+			elapsed = time.perf_counter() - start
+
+			r = self.response
+			recorder._record(method,
+			    urllib.parse.urljoin(self.host, url), r, elapsed)
+
+		return request
+
+	def _record(self, method, url, resp, elapsed):
+		ent = dict(key=_key(method, url, self._ignoreparams),
+		    status=resp.status_code, reason=resp.reason,
+		    headers=dict(resp.headers), elapsed=elapsed,
+		    body=base64.b64encode(_redact(resp.content)).decode('us-ascii'))
+
+		# content-encoding was undone when reading content
+		ent['headers'].pop('Content-Encoding', None)
+
+		with self._lock, open(self._path, 'a') as fp:
+			fp.write(json.dumps(ent) + '\n')
+
+class Replayer(_Patcher):
+	'''Answer the libcloud requests while active from the recording
+	in the file path.  A request that was not recorded raises
+	KeyError.'''
+
+	def __init__(self, path, timescale=1.0, ignoreparams=IGNOREPARAMS):
+		self._timescale = timescale
+		self._ignoreparams = ignoreparams
+		self._lock = threading.Lock()
+		self._resps = {}
+
+		with open(path) as fp:
+			for line in fp:
+				ent = json.loads(line)
+				self._resps.setdefault(ent['key'], []).append(ent)
+
+	def _mkrequest(self, orig):
+		replayer = self
+
+		def request(self, method, url, *args, **kwargs):
+			self.response = replayer._replay(method,
+			    urllib.parse.urljoin(self.host, url))
+
+		return request
+
+	def _replay(self, method, url):
+		key = _key(method, url, self._ignoreparams)
+		with self._lock:
+			ents = self._resps[key]
+			ent = ents.pop(0) if len(ents) > 1 else ents[0]
+
+		if self._timescale:
+			time.sleep(ent['elapsed'] * self._timescale)
+
+		r = requests.Response()
+		r.status_code = ent['status']
+		r.reason = ent['reason']
+		r.headers = requests.structures.CaseInsensitiveDict(ent['headers'])
+		r._content = base64.b64decode(ent['body'])
+		r.url = url
+		r.encoding = requests.utils.get_encoding_from_headers(r.headers)
+
+		return r
+
+class CloudReplayTest(unittest.TestCase):
+	def setUp(self):
+		self.tmpfile = tempfile.NamedTemporaryFile()
+		self.path = self.tmpfile.name
+
+	def tearDown(self):
+		self.tmpfile.close()
+
+	def mkresp(self, body, status=200):
+		r = requests.Response()
+		r.status_code = status
+		r.reason = 'OK'
+		r.headers = requests.structures.CaseInsensitiveDict({
+		    'Content-Type': 'application/json' })
+		r._content = body
+		return r
+
+	def test_recordreplay(self):
+		conn = LibcloudConnection('example.com', 443)
+
+		resps = [ self.mkresp(b'{"items": [1]}'),
+		    self.mkresp(b'{"items": [2]}'),
+		    self.mkresp(b'{"access_token": "secret", "expires_in": 3600}') ]
+
+		with patch.object(conn.session, 'request') as req:
+			req.side_effect = resps
+
+			# That when recording
+			with Recorder(self.path):
+				conn.request('GET', '/list?b=1&a=2&Signature=x')
+				conn.request('GET', '/list?a=2&b=1&Signature=y')
+				conn.request('POST', '/token')
+
+		# that the recording has no secrets
+		with open(self.path) as fp:
+			self.assertNotIn('secret', fp.read())
+
+		with patch.object(conn.session, 'request') as req:
+			# That when replaying
+			with Replayer(self.path, timescale=0):
+				conn.request('GET', '/list?a=2&b=1&Signature=z')
+				self.assertEqual(conn.getresponse().status_code, 200)
+				self.assertEqual(conn.response.json(), { 'items': [ 1 ] })
+
+				# that the responses are in order
+				conn.request('GET', '/list?a=2&b=1')
+				self.assertEqual(conn.response.json(), { 'items': [ 2 ] })
+
+				# and the last one repeats
+				conn.request('GET', '/list?a=2&b=1')
+				self.assertEqual(conn.response.json(), { 'items': [ 2 ] })
+
+				# and tokens are redacted
+				conn.request('POST', '/token')
+				self.assertEqual(conn.response.json()['access_token'],
+				    'REDACTED')
+
+				# and that an unrecorded request fails
+				self.assertRaises(KeyError, conn.request, 'GET',
+				    '/other')
+
+			# and that the network was not used
+			req.assert_not_called()
+
+	def test_timescale(self):
+		with open(self.path, 'w') as fp:
+			fp.write(json.dumps(dict(key=_key('GET',
+			    'https://example.com/list', IGNOREPARAMS), status=200,
+			    reason='OK', headers={}, elapsed=.1,
+			    body=base64.b64encode(b'{}').decode('us-ascii'))) + '\n')
+
+		conn = LibcloudConnection('example.com', 443)
+
+		# That the replay is slowed by the time scale
+		with Replayer(self.path, timescale=.5):
+			start = time.perf_counter()
+			conn.request('GET', '/list')
+			self.assertGreaterEqual(time.perf_counter() - start, .05)
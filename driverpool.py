@@ -0,0 +1,190 @@
+'''Cloud drivers that are ready before a command needs one.
+
+Creating a driver, and for GCE authenticating it (loading the key,
+signing a JWT and fetching an OAuth token), can take seconds.  The
+DriverPool creates drivers ahead of time, hands them out to requests,
+and takes them back when the request is done.  The drivers share one
+OAuth credential, which a background thread refreshes before it
+expires, so no command waits on authentication.'''
+
+import datetime
+import queue
+import threading
+import time
+import unittest
+
+from mock import MagicMock
+
+def _utcnow():
+	return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+class DriverPool(object):
+	def __init__(self, factory, size=4, margin=300, interval=30):
+		'''factory is called w/o arguments to create a driver.  size
+		drivers are created by warm.  A token is refreshed when it
+		expires in less than margin seconds, checked every interval
+		seconds.'''
+
+		self._factory = factory
+		self._size = size
+		self._margin = margin
+		self._interval = interval
+		self._pool = queue.LifoQueue()
+		self._lock = threading.Lock()
+		self._cred = None
+		self._thread = None
+
+		self._created = 0
+		self._refreshes = 0
+		self._lastrefresh = None
+		self._lasterror = None
+
+	def _create(self):
+		drv = self._factory()
+
+		with self._lock:
+			self._created += 1
+			cred = getattr(drv.connection, 'oauth2_credential', None)
+			if cred is not None:
+				if self._cred is None:
+					self._cred = cred
+					self._lastrefresh = time.time()
+				else:
+					drv.connection.oauth2_credential = self._cred
+
+		return drv
+
+	def get(self):
+		'''Return a driver, creating one if none are available.'''
+
+		try:
+			return self._pool.get_nowait()
+		except queue.Empty:
+			return self._create()
+
+	def put(self, drv):
+		'''Return a driver from get to the pool.'''
+
+		self._pool.put(drv)
+
+	def warm(self):
+		'''Fill the pool, and refresh the credential if needed.'''
+
+		while self._pool.qsize() < self._size:
+			self.put(self._create())
+
+		self.refresh()
+
+	def refresh(self, force=False):
+		'''Refresh the shared credential if it expires soon.'''
+
+		cred = self._cred
+		if cred is None:
+			return
+
+		expires = (cred.token_expire_utc_datetime -
+		    _utcnow()).total_seconds()
+		if force or expires < self._margin:
+			cred._refresh_token()
+			with self._lock:
+				self._refreshes += 1
+				self._lastrefresh = time.time()
+
+	def start(self):
+		'''Warm up in the background, and keep the credential fresh.'''
+
+		def run():
+			while True:
+				try:
+					self.warm()
+					self._lasterror = None
+				except Exception as e:
+					self._lasterror = repr(e)
+				time.sleep(self._interval)
+
+		self._thread = threading.Thread(target=run, name='driverpool',
+		    daemon=True)
+		self._thread.start()
+
+	def stats(self):
+		'''Return a dict describing the pool and the credential.  The
+		times are in seconds, and are None when the driver does not
+		use a token.'''
+
+		with self._lock:
+			res = dict(available=self._pool.qsize(),
+			    created=self._created, refreshes=self._refreshes,
+			    error=self._lasterror, token_age=None,
+			    token_expires_in=None)
+
+			if self._cred is not None:
+				res['token_age'] = time.time() - self._lastrefresh
+				res['token_expires_in'] = (
+				    self._cred.token_expire_utc_datetime -
+				    _utcnow()).total_seconds()
+
+		return res
+
+class DriverPoolTest(unittest.TestCase):
+	def mkdriver(self):
+		drv = MagicMock()
+		drv.connection.oauth2_credential = MagicMock()
+		drv.connection.oauth2_credential.token_expire_utc_datetime = \
+		    _utcnow() + datetime.timedelta(seconds=self.expires)
+		return drv
+
+	def test_pool(self):
+		self.expires = 3600
+		dp = DriverPool(self.mkdriver, size=2)
+
+		# That a warmed pool
+		dp.warm()
+
+		# has the drivers
+		self.assertEqual(dp.stats()['available'], 2)
+
+		# and they share a credential
+		a = dp.get()
+		b = dp.get()
+		self.assertIs(a.connection.oauth2_credential,
+		    b.connection.oauth2_credential)
+
+		# and that it was not refreshed
+		a.connection.oauth2_credential._refresh_token.assert_not_called()
+
+		# That an empty pool creates a driver
+		c = dp.get()
+		self.assertEqual(dp.stats()['created'], 3)
+
+		# and that returned drivers are reused
+		dp.put(c)
+		self.assertIs(dp.get(), c)
+
+		# and the token age is reported
+		stats = dp.stats()
+		self.assertLess(stats['token_age'], 5)
+		self.assertGreater(stats['token_expires_in'], 3000)
+
+	def test_refresh(self):
+		self.expires = 60
+		dp = DriverPool(self.mkdriver, size=1, margin=300)
+
+		# That when the token expires within the margin
+		dp.warm()
+
+		# that it is refreshed
+		cred = dp.get().connection.oauth2_credential
+		cred._refresh_token.assert_called_once_with()
+		self.assertEqual(dp.stats()['refreshes'], 1)
+
+	def test_nocredential(self):
+		drv = MagicMock(spec=[ 'connection' ])
+		drv.connection = MagicMock(spec=[])
+		dp = DriverPool(lambda: drv, size=1)
+
+		# That drivers w/o a token work
+		dp.warm()
+		self.assertIs(dp.get(), drv)
+
+		# and report no token
+		self.assertIsNone(dp.stats()['token_age'])
@@ -1,20 +1,45 @@
-from flask import Flask, render_template, request, abort
+from flask import Flask, render_template, request, abort, make_response
 from svalid import svalid
-from mock import patch
+from mock import patch, MagicMock
 
 from openc2 import Command, Response, CustomTarget
+from openc2.base import OpenC2JSONEncoder
+from hashring import ActuatorPool, HashRing
+from pubsub import CMDTOPIC, RSPTOPIC, devicetopic, mkenvelope, parseenvelope
+from pubsub import parsebroker
 from stix2 import properties
+from accesslog import AccessLog
 
 import itertools
 import json
+import logging
 import openc2
+import os
 import pha
 import requests
+import time
 import uuid
 
+# The binary encodings are optional, only the installed ones are
+# offered.
+try:
+	import cbor2
+except ImportError:	# pragma: no cover
+	cbor2 = None
+
+try:
+	import msgpack
+except ImportError:	# pragma: no cover
+	msgpack = None
+
 @CustomTarget('x-newcontext-com:aws', [
 	('image', properties.StringProperty()),
 	('instance', properties.StringProperty()),
+	('wait', properties.StringProperty()),
+	('inventory', properties.DictionaryProperty()),
+	('desired', properties.DictionaryProperty()),
+	('report', properties.DictionaryProperty()),
+	('selector', properties.DictionaryProperty()),
 ])
 class NewContextAWS(object):
 	pass
@@ -24,15 +49,58 @@ QUERY = 'query'
 START = 'start'
 STOP = 'stop'
 DELETE = 'delete'
+SET = 'set'
 
 app = Flask(__name__)
 
+# Encoding used for messages to the actuator, see _codecs.
+oc2format = 'json'
+
+# The actuators to send commands to, comma separated in
+# OPENC2_ACTUATORS.  Commands for an instance always go to the same
+# healthy actuator.
+actuators = os.environ.get('OPENC2_ACTUATORS',
+    'http://localhost:5001/ec2').split(',')
+
+# Seconds between health checks when there are multiple actuators.
+healthinterval = 10
+
+# Seconds an actuator may take to run a command, sent to it in the
+# X-Command-Timeout header.  The response is waited on for a few seconds
+# longer, so that the actuator's timeout response is received.
+cmdtimeout = float(os.environ.get('OPENC2_COMMAND_TIMEOUT', '300'))
+
+# When set by use_pubsub, commands are published to this broker instead
+# of being sent over HTTP.  Queries go to every actuator, the other
+# commands to one of oc2devices, picked like the HTTP actuators.
+oc2broker = None
+oc2devices = HashRing()
+
+# To log each published command as JSON, w/ the actuator it was sent
+# to, its status and latency, set OPENC2_ACCESS_LOG and
+# OPENC2_ACCESS_SAMPLE as for the backend.  See accesslog.py.
+accesslogpath = os.environ.get('OPENC2_ACCESS_LOG')
+
+if accesslogpath:
+	accesslog = AccessLog(logging.StreamHandler() if accesslogpath ==
+	    '-' else logging.FileHandler(accesslogpath),
+	    float(os.environ.get('OPENC2_ACCESS_SAMPLE', '1')),
+	    'openc2.frontend.access')
+	accesslog.start()
+else:
+	accesslog = None
+
+# command id -> (topic, when published), of the commands published to
+# the broker, until their response is logged
+_published = {}
+
 _instcmds = ('Query', 'Start', 'Stop', 'Delete')
 
 class AWSOpenC2Proxy(object):
 	def __init__(self):
 		self._pending = {}
 		self._ids = {}
+		self._version = 0
 		self._baditer = ('badcreate-%d' % i for i in itertools.count(1))
 
 	def pending(self):
@@ -44,18 +112,54 @@ class AWSOpenC2Proxy(object):
 	def status(self, inst):
 		return self._ids[inst]
 
-	def process_msg(self, cmdid, msg):
-		resp = _deseropenc2(msg)
+	def version(self):
+		'''Returns a number that increases whenever ec2ids changes.'''
 
+		return self._version
+
+	def process_msg(self, cmdid, msg, fmt='json'):
+		'''Update the state from the response msg to the command
+		cmdid, and return it, or None if it is invalid.'''
+
+		# no longer pending, even if the response is invalid
 		cmd = self._pending.pop(cmdid)
-		if cmd.action == CREATE:
+
+		try:
+			resp = _deseropenc2(msg, fmt)
+		except Exception as e:
+			# e.g. an empty inventory from an older actuator
+			app.logger.error('invalid response to %s: %r', cmdid, e)
+			if 'instance' in cmd.target:
+				self._ids[cmd.target['instance']] = (
+				    'invalid response')
+				self._version += 1
+			return None
+
+		if 'wait' in cmd.target and resp.status // 100 in (1, 2):
+			# the status text is the state waited for (or reached)
+			if cmd.action == CREATE:
+				inst = resp.results['instance']
+			else:
+				inst = cmd.target['instance']
+			self._ids[inst] = resp.status_text
+		elif cmd.action == CREATE:
 			if resp.status // 100 != 2:
 				self._ids[next(self._baditer)] = (
 				    resp.status_text)
 			else:
 				self._ids[resp.results['instance']] = 'marked create'
+		elif cmd.action == QUERY and 'instance' not in cmd.target:
+			# the whole fleet, or the selected instances
+			results = resp.get('results') or {}
+			self._ids.update(results.get('inventory', {}))
 		elif cmd.action == QUERY:
 			self._ids[cmd.target['instance']] = resp.status_text
+		elif cmd.action == SET or 'selector' in cmd.target:
+			# the instances changed by a reconcile or a selector
+			results = resp.get('results') or {}
+			for inst, outcome in results.get('report', {}).items():
+				if outcome != 'unchanged':
+					self._ids[inst] = outcome
 		elif cmd.action in (START, STOP, DELETE):
 			if resp.status // 100 != 2:
 				self._ids[cmd.target['instance']] = (
@@ -67,39 +171,80 @@ class AWSOpenC2Proxy(object):
 			# only can happen when internal state error
 			raise RuntimeError
 
+		self._version += 1
+
+		return resp
+
 	def _cmdpub(self, action, **kwargs):
 		ocpkwargs = {}
 		if 'meth' in kwargs:
 			ocpkwargs['meth'] = kwargs.pop('meth')
 
-		cmd = Command(action=action, target=NewContextAWS(**kwargs))
 		cmduuid = str(uuid.uuid4())
 
+		# the actuator is picked by instance, the other commands,
+		# e.g. unnamed creates, are spread by their id
+		ocpkwargs['key'] = kwargs.get('instance') or cmduuid
+
+		if kwargs.get('wait') is None:
+			kwargs.pop('wait', None)
+
+		cmd = Command(action=action, target=NewContextAWS(**kwargs))
+
 		self._pending[cmduuid] = cmd
 
 		# Do not do any state change after this line.
 		# If _publish is sync, a response may come back before
 		# we return from this function
 
-		msg = _seropenc2(cmd)
+		if oc2format != 'json':
+			ocpkwargs['fmt'] = oc2format
+
+		msg = _seropenc2(cmd, oc2format)
 		openc2_publish(cmduuid, msg, **ocpkwargs)
 
 		return cmduuid
 
-	def amicreate(self, ami):
-		return self._cmdpub(CREATE, image=ami)
+	# The optional wait argument makes the actuator block until the
+	# instance reaches that state, e.g. 'running'.
+
+	def amicreate(self, ami, wait=None):
+		return self._cmdpub(CREATE, image=ami, wait=wait)
+
+	def ec2query(self, inst, wait=None):
+		return self._cmdpub(QUERY, instance=inst, meth='get', wait=wait)
+
+	def ec2inventory(self):
+		'''Query the state of every instance.'''
+
+		return self._cmdpub(QUERY, meth='get')
+
+	def ec2start(self, inst, wait=None):
+		return self._cmdpub(START, instance=inst, wait=wait)
+
+	def ec2stop(self, inst, wait=None):
+		return self._cmdpub(STOP, instance=inst, wait=wait)
 
-	def ec2query(self, inst):
-		return self._cmdpub(QUERY, instance=inst, meth='get')
+	def ec2delete(self, inst, wait=None):
+		return self._cmdpub(DELETE, instance=inst, wait=wait)
 
-	def ec2start(self, inst):
-		return self._cmdpub(START, instance=inst)
+	def ec2selected(self, action, selector):
+		'''Run action (query, start, stop or delete) on every instance
+		that has the labels (tags on EC2) in the dict selector.'''
 
-	def ec2stop(self, inst):
-		return self._cmdpub(STOP, instance=inst)
+		meth = 'get' if action == QUERY else 'post'
 
-	def ec2delete(self, inst):
-		return self._cmdpub(DELETE, instance=inst)
+		return self._cmdpub(action, selector=selector, meth=meth)
+
+	def ec2reconcile(self, desired, image=None):
+		'''Bring the instances to the states in desired, a dict of
+		instance name to running, stopped or deleted.  Missing
+		instances are created from image.'''
+
+		if image is None:
+			return self._cmdpub(SET, desired=desired)
+
+		return self._cmdpub(SET, desired=desired, image=image)
 
 	def __contains__(self, item):
 		return item in self._pending
@@ -123,28 +268,192 @@ def get_ec2(obj=[]):
 
 	return obj[0]
 
-def _selfpatch(name):
-	return patch('%s.%s' % (__name__, name))
+def _selfpatch(name, *args):
+	return patch('%s.%s' % (__name__, name), *args)
+
+# Encodings of OpenC2 messages, format name: (encode, decode).  The
+# format name is the suffix of the media type, e.g.
+# application/openc2-rsp+cbor;version=1.0.  The binary encodings carry
+# the same structure as the JSON.
+_codecs = {
+	'json': (lambda x: json.dumps(x).encode('utf-8'), json.loads),
+}
+
+if cbor2 is not None:
+	_codecs['cbor'] = (cbor2.dumps, cbor2.loads)
+
+if msgpack is not None:
+	_codecs['msgpack'] = (msgpack.packb,
+	    lambda x: msgpack.unpackb(x, raw=False))
+
+def _oc2mimetype(kind, fmt='json'):
+	'''Return the media type for kind ('cmd' or 'rsp') messages
+	in format fmt.'''
+
+	return 'application/openc2-%s+%s;version=1.0' % (kind, fmt)
+
+def _oc2format(mimetypes):
+	'''Return the first supported format in a Content-Type or Accept
+	header value, or json if none is.'''
+
+	for i in mimetypes.split(','):
+		mt = i.split(';')[0].strip()
+		if mt.startswith('application/openc2-') and '+' in mt:
+			fmt = mt.rsplit('+', 1)[1]
+			if fmt in _codecs:
+				return fmt
+
+	return 'json'
 
-def _seropenc2(msg):
-	return msg.serialize()
+_oc2encoder = OpenC2JSONEncoder()
 
-def _deseropenc2(msg):
-	return openc2.parse(msg)
+def _plain(obj):
+	'''Return obj, w/ the OpenC2 objects in it converted to the dicts,
+	lists, strings and numbers they serialize to as JSON.'''
 
-def openc2_publish(cmdid, oc2msg, meth='post'):
-	app.logger.debug('publishing msg: %s' % repr(oc2msg))
+	if isinstance(obj, (str, int, float, type(None))):
+		return obj
+	if isinstance(obj, dict):
+		return { k: _plain(v) for k, v in obj.items() }
+	if isinstance(obj, (list, tuple)):
+		return [ _plain(x) for x in obj ]
 
-	resp = getattr(requests, meth)('http://localhost:5001/ec2', data=oc2msg,
-	    headers={ 'X-Request-ID': cmdid })
-	msg = resp.text
+	return _plain(_oc2encoder.default(obj))
 
-	app.logger.debug('response msg: %s' % repr(msg))
+def _seropenc2(msg, fmt='json'):
+	if fmt == 'json':
+		return msg.serialize()
 
-	get_ec2().process_msg(resp.headers['X-Request-ID'], msg)
+	# w/o going through JSON
+	return _codecs[fmt][0](_plain(msg))
+
+def _deseropenc2(msg, fmt='json'):
+	if fmt == 'json':
+		return openc2.parse(msg)
+
+	return openc2.parse(_codecs[fmt][1](msg))
+
+def _healthcheck(actuator):
+	# the health check is under the actuator's path
+	return requests.get(actuator.rstrip('/') + '/health',
+	    timeout=5).status_code == 200
+
+actuatorpool = ActuatorPool(actuators, _healthcheck)
+if len(actuators) > 1:
+	actuatorpool.start(healthinterval)
+
+def openc2_publish(cmdid, oc2msg, meth='post', fmt='json', key=None):
+	'''Send oc2msg to an actuator.  The actuator is picked by key,
+	and if it can not be reached, the next one is tried.'''
+
+	app.logger.debug('publishing msg: %r', oc2msg)
+
+	sent = time.monotonic()
+	if oc2broker is not None:
+		# A command that changes instances must run only once.
+		if meth == 'get':
+			topic = CMDTOPIC
+		elif oc2devices.nodes():
+			topic = devicetopic(oc2devices.get(key or cmdid))
+		else:
+			raise RuntimeError('no device ids to send commands to')
+
+		# the response is processed, and logged, when it is
+		# published back
+		if accesslog is not None:
+			_published[cmdid] = (topic, sent)
+		oc2broker.publish(topic, mkenvelope(cmdid, oc2msg, fmt))
+		return None
+
+	headers = { 'X-Request-ID': cmdid,
+	    'X-Command-Timeout': '%g' % cmdtimeout }
+	if fmt != 'json':
+		headers['Content-Type'] = _oc2mimetype('cmd', fmt)
+		headers['Accept'] = _oc2mimetype('rsp', fmt)
+
+	for url in actuatorpool.candidates(key):
+		try:
+			resp = getattr(requests, meth)(url, data=oc2msg,
+			    headers=headers, timeout=cmdtimeout + 5)
+			break
+		except requests.Timeout:
+			# the command may still be running, so it is not
+			# sent to another actuator
+			app.logger.error('actuator timed out: %r', url)
+			msg = _seropenc2(Response(status=408,
+			    status_text='actuator timed out'))
+			get_ec2().process_msg(cmdid, msg)
+			_logpub(cmdid, url, 408, sent)
+			return msg
+		except requests.ConnectionError:
+			app.logger.debug('actuator down: %r', url)
+			actuatorpool.markdown(url)
+	else:
+		_logpub(cmdid, None, 503, sent)
+		raise RuntimeError('no actuator available')
+
+	rfmt = _oc2format(resp.headers.get('Content-Type', ''))
+	if rfmt == 'json':
+		msg = resp.text
+		args = ()
+	else:
+		msg = resp.content
+		args = (rfmt,)
+
+	app.logger.debug('response msg: %r', msg)
+
+	get_ec2().process_msg(resp.headers['X-Request-ID'], msg, *args)
+	_logpub(cmdid, url, resp.status_code, sent)
 
 	return msg
 
+def _logpub(cmdid, actuator, status, sent):
+	if accesslog is None or not accesslog.enabled(status):
+		return
+
+	accesslog.log(request_id=cmdid, actuator=actuator, status=status,
+	    latency=time.monotonic() - sent)
+
+def use_pubsub(broker, devices=()):
+	'''Publish commands to broker, and process the responses that
+	are published to it.  The commands other than queries are sent
+	to one of the actuators w/ the device ids devices.'''
+
+	global oc2broker, oc2devices
+
+	broker.subscribe(RSPTOPIC, _pubsubresp)
+	oc2devices = HashRing(devices)
+	oc2broker = broker
+
+def _pubsubresp(topic, payload):
+	cmdid, body, fmt = parseenvelope(payload)
+
+	ec2 = get_ec2()
+	if cmdid not in ec2:
+		# When fanned out to multiple actuators, only the first
+		# response is processed.
+		app.logger.debug('dropping response: %r', cmdid)
+		return
+
+	if fmt == 'json':
+		resp = ec2.process_msg(cmdid, body)
+	else:
+		resp = ec2.process_msg(cmdid, body, fmt)
+
+	try:
+		topic, sent = _published.pop(cmdid)
+	except KeyError:
+		return
+
+	_logpub(cmdid, topic, resp.status if resp is not None else 500, sent)
+
+# To publish commands to an MQTT broker, set to host[:port], and the
+# device ids of the actuators, comma separated, in OPENC2_DEVICE_IDS.
+if os.environ.get('OPENC2_MQTT_BROKER'):
+	use_pubsub(parsebroker(os.environ['OPENC2_MQTT_BROKER']),
+	    [ x for x in os.environ.get('OPENC2_DEVICE_IDS', '').split(',')
+	    if x ])
+
 @app.route('/', methods=['GET', 'POST'])
 def frontpage():
 	if request.method == 'POST':
@@ -159,7 +468,38 @@ def frontpage():
 			else:
 				abort(400)
 
-	return render_template('index.html', ec2ids=ec2ids(), instcmds=_instcmds)
+	# The page only changes w/ the proxy's state, so the version is
+	# the ETag.  The prefix keeps a restarted frontend from matching
+	# a previous one's ETags.
+	ver = version()
+	etag = '%s-%d' % (_etagprefix, ver)
+	if request.method == 'GET' and request.if_none_match.contains(etag):
+		resp = make_response('', 304)
+	else:
+		resp = make_response(_renderpage(ver))
+
+	resp.set_etag(etag)
+
+	return resp
+
+_etagprefix = uuid.uuid4().hex[:16]
+
+# version: rendered page, only the current version is kept
+_pagecache = {}
+
+def _renderpage(ver):
+	try:
+		return _pagecache[ver]
+	except KeyError:
+		pass
+
+	page = render_template('index.html', ec2ids=ec2ids(),
+	    instcmds=_instcmds)
+
+	_pagecache.clear()
+	_pagecache[ver] = page
+
+	return page
 
 import unittest
 
@@ -169,6 +509,9 @@ class FrontendTest(unittest.TestCase):
 	def setUp(self):
 		self.test_client = app.test_client(self)
 
+		# tests patch ec2ids w/o changing the version
+		_pagecache.clear()
+
 	@unittest.skipIf(_skipSlowTests, 'slow')
 	@_selfpatch('AWSOpenC2Proxy.ec2ids')
 	def test_index(self, ec2idmock):
@@ -229,7 +572,8 @@ class FrontendTest(unittest.TestCase):
 			# and that it was passed to the actuator
 			mockpost.assert_called_with(
 			    'http://localhost:5001/ec2', data=msg,
-			    headers={ 'X-Request-ID': cmdid })
+			    headers={ 'X-Request-ID': cmdid,
+			    'X-Command-Timeout': '300' }, timeout=305)
 
 			# That it was passed on to processing
 			mockprocmsg.assert_called_once_with(cmdid, retmsg)
@@ -246,7 +590,277 @@ class FrontendTest(unittest.TestCase):
 			# and that it was passed to the actuator
 			mockget.assert_called_with(
 			    'http://localhost:5001/ec2', data=msg,
-			    headers={ 'X-Request-ID': cmdid })
+			    headers={ 'X-Request-ID': cmdid,
+			    'X-Command-Timeout': '300' }, timeout=305)
+
+	@_selfpatch('AWSOpenC2Proxy.process_msg')
+	@patch('requests.post')
+	def test_oc2pubfmt(self, mockpost, mockprocmsg):
+		msg = b'foobar'
+		cmdid = 'somecmdid'
+		retmsg = b'bleh'
+
+		mockpost().content = retmsg
+		mockpost().headers = { 'X-Request-ID': cmdid,
+		    'Content-Type': _oc2mimetype('rsp', 'cbor') }
+
+		with app.app_context():
+			# That when a message is published as cbor
+			r = openc2_publish(cmdid, msg, fmt='cbor')
+
+			# it returns the message
+			self.assertEqual(r, retmsg)
+
+			# and that it was passed w/ the content type
+			mockpost.assert_called_with(
+			    'http://localhost:5001/ec2', data=msg,
+			    headers={ 'X-Request-ID': cmdid,
+			    'X-Command-Timeout': '300',
+			    'Content-Type': 'application/openc2-cmd+cbor;version=1.0',
+			    'Accept': 'application/openc2-rsp+cbor;version=1.0' },
+			    timeout=305)
+
+			# That it was passed on to processing as cbor
+			mockprocmsg.assert_called_once_with(cmdid, retmsg, 'cbor')
+
+	@_selfpatch('actuatorpool',
+	    ActuatorPool([ 'http://a/ec2', 'http://b/ec2' ], None))
+	@_selfpatch('AWSOpenC2Proxy.process_msg')
+	@patch('requests.post')
+	def test_oc2pubfailover(self, mockpost, mockprocmsg):
+		msg = 'foobar'
+		cmdid = 'somecmdid'
+		inst = 'someinst'
+
+		first, second = actuatorpool.candidates(inst)
+
+		resp = MagicMock()
+		resp.text = 'bleh'
+		resp.headers = { 'X-Request-ID': cmdid }
+
+		# That when the actuator for an instance is down
+		mockpost.side_effect = [ requests.ConnectionError(), resp ]
+
+		with app.app_context():
+			# and a message is published
+			openc2_publish(cmdid, msg, key=inst)
+
+		# that it was tried first
+		self.assertEqual(mockpost.call_args_list[0][0], (first,))
+
+		# and then the next actuator was used
+		self.assertEqual(mockpost.call_args_list[1][0], (second,))
+		mockprocmsg.assert_called_once_with(cmdid, 'bleh')
+
+		# and that it is marked down
+		self.assertTrue(actuatorpool.isdown(first))
+
+		# That when the actuator does not respond in time
+		mockprocmsg.reset_mock()
+		mockpost.reset_mock()
+		mockpost.side_effect = requests.ReadTimeout()
+
+		with app.app_context(), self.assertLogs(app.logger, 'ERROR'):
+			openc2_publish(cmdid, msg, key=inst)
+
+		# that no other actuator is tried
+		self.assertEqual(mockpost.call_count, 1)
+
+		# and that the command gets a timeout response
+		mockprocmsg.assert_called_once()
+		self.assertEqual(mockprocmsg.call_args[0][0], cmdid)
+		resp = _deseropenc2(mockprocmsg.call_args[0][1])
+		self.assertEqual(resp.status, 408)
+
+		# That when all are down
+		mockpost.side_effect = requests.ConnectionError()
+
+		# that it raises an error
+		with app.app_context():
+			self.assertRaises(RuntimeError, openc2_publish, cmdid,
+			    msg, key=inst)
+
+	@_selfpatch('oc2devices')
+	@_selfpatch('oc2broker')
+	@_selfpatch('AWSOpenC2Proxy.process_msg')
+	def test_oc2pubsub(self, mockprocmsg, oldbroker, olddevices):
+		from pubsub import LocalBroker
+
+		msg = 'foobar'
+		cmdid = 'somecmdid'
+		retmsg = 'bleh'
+
+		broker = LocalBroker()
+		cmds = []
+
+		# two actuators that reply to commands
+		def actuator(topic, payload):
+			cmds.append(payload)
+			rcmdid, body, fmt = parseenvelope(payload)
+			broker.publish(RSPTOPIC, mkenvelope(rcmdid, retmsg))
+
+		broker.subscribe(CMDTOPIC, actuator)
+		broker.subscribe(CMDTOPIC, actuator)
+
+		use_pubsub(broker)
+
+		# That w/o device ids, a command that changes instances
+		# can not be published
+		self.assertRaises(RuntimeError, openc2_publish, cmdid, msg)
+
+		with patch.object(AWSOpenC2Proxy, '__contains__') as contains:
+			contains.side_effect = [ True, False ]
+
+			# That when a query is published
+			r = openc2_publish(cmdid, msg, meth='get')
+
+			# it does not wait for a response
+			self.assertIsNone(r)
+
+			broker.join()
+
+		# That the actuators got it
+		self.assertEqual([ parseenvelope(x) for x in cmds ],
+		    [ (cmdid, msg, 'json') ] * 2)
+
+		# and only the first response was processed
+		mockprocmsg.assert_called_once_with(cmdid, retmsg)
+
+		# That w/ device ids
+		use_pubsub(broker, [ 'act1', 'act2' ])
+		devcmds = { 'act1': [], 'act2': [] }
+		for i in devcmds:
+			broker.subscribe(devicetopic(i),
+			    lambda t, p, i=i: devcmds[i].append(p))
+
+		del cmds[:]
+		with patch.object(AWSOpenC2Proxy, '__contains__') as contains:
+			contains.return_value = False
+
+			# a command that changes instances
+			openc2_publish(cmdid, msg, key='someinst')
+			openc2_publish(cmdid, msg, key='someinst')
+			broker.join()
+
+		# goes to only one actuator
+		self.assertEqual(cmds, [])
+		self.assertEqual(sorted(len(x) for x in devcmds.values()),
+		    [ 0, 2 ])
+
+	@_selfpatch('oc2devices', HashRing())
+	@_selfpatch('oc2broker', None)
+	@_selfpatch('actuatorpool', ActuatorPool([ 'http://a/ec2' ], None))
+	@_selfpatch('AWSOpenC2Proxy.process_msg')
+	@patch('requests.post')
+	def test_oc2publog(self, mockpost, mockprocmsg):
+		import io
+		from pubsub import LocalBroker
+
+		out = io.StringIO()
+		al = AccessLog(logging.StreamHandler(out),
+		    name='openc2.test.frontend')
+		al.start()
+
+		resp = MagicMock()
+		resp.text = 'bleh'
+		resp.status_code = 200
+		resp.headers = { 'X-Request-ID': 'cmd1' }
+
+		with _selfpatch('accesslog', al), app.app_context(), \
+		    self.assertLogs(app.logger, 'ERROR'):
+			# That when a command is sent to an actuator
+			mockpost.side_effect = [ resp ]
+			openc2_publish('cmd1', 'foobar', key='inst')
+
+			# and one times out
+			mockpost.side_effect = requests.ReadTimeout()
+			openc2_publish('cmd2', 'foobar', key='inst')
+
+			# and one is published to a broker
+			broker = LocalBroker()
+			broker.subscribe(CMDTOPIC, lambda t, p:
+			    broker.publish(RSPTOPIC, mkenvelope('cmd3', 'bleh')))
+			use_pubsub(broker)
+			mockprocmsg.return_value = Response(status=200)
+			with patch.object(AWSOpenC2Proxy, '__contains__') as \
+			    contains:
+				contains.return_value = True
+				openc2_publish('cmd3', 'foobar', meth='get')
+				broker.join()
+		al.stop()
+
+		recs = [ json.loads(x) for x in out.getvalue().splitlines() ]
+
+		# that each is logged w/ the actuator and status
+		self.assertEqual([ (x['request_id'], x['actuator'],
+		    x['status']) for x in recs ], [
+		    ('cmd1', 'http://a/ec2', 200),
+		    ('cmd2', 'http://a/ec2', 408),
+		    ('cmd3', CMDTOPIC, 200) ])
+
+		# and the latency
+		self.assertTrue(all(x['latency'] >= 0 for x in recs))
+
+		# and that the published command is no longer kept
+		self.assertNotIn('cmd3', _published)
+
+	def test_oc2format(self):
+		# That the default is json
+		self.assertEqual(_oc2format(''), 'json')
+		self.assertEqual(_oc2format('*/*'), 'json')
+
+		# That the first supported format is used
+		self.assertEqual(_oc2format('application/openc2-rsp+bogus, '
+		    'application/openc2-rsp+msgpack;version=1.0'), 'msgpack')
+
+		# That each format round trips
+		for fmt in _codecs:
+			resp = Response(status=200, status_text='running')
+			self.assertEqual(_deseropenc2(_seropenc2(resp, fmt),
+			    fmt).status_text, 'running')
+
+		# That the plain objects are those of the JSON
+		cmd = Command(action='query', target=NewContextAWS(
+		    instance='someinst', selector={ 'env': 'prod' }))
+		for i in (cmd, Response(status=200, status_text='running')):
+			self.assertEqual(_plain(i), json.loads(i.serialize()))
+
+	@_selfpatch('AWSOpenC2Proxy.version')
+	@_selfpatch('AWSOpenC2Proxy.ec2ids')
+	def test_etag(self, ec2idmock, vermock):
+		ec2idmock.return_value = { 'ec2ida': 'running' }
+		vermock.return_value = 1
+
+		# That a request for the root resource
+		response = self.test_client.get('/')
+
+		# is successful and has an ETag
+		self.assertEqual(response.status_code, 200)
+		etag = response.headers['ETag']
+
+		# That a conditional request w/ the ETag
+		response = self.test_client.get('/',
+		    headers={ 'If-None-Match': etag })
+
+		# is not modified
+		self.assertEqual(response.status_code, 304)
+		self.assertEqual(response.data, b'')
+
+		# and the page was rendered only once
+		ec2idmock.assert_called_once_with()
+
+		# That when the state changes
+		vermock.return_value = 2
+		ec2idmock.return_value = { 'ec2idb': 'running' }
+
+		# a conditional request w/ the old ETag
+		response = self.test_client.get('/',
+		    headers={ 'If-None-Match': etag })
+
+		# returns the new page
+		self.assertEqual(response.status_code, 200)
+		self.assertNotEqual(response.headers['ETag'], etag)
+		self.assertIn(b'ec2idb', response.data)
 
 	def test_badpost(self):
 		# That a create request
@@ -303,9 +917,11 @@ class ProxyClassTest(unittest.TestCase):
 			# That is returns the uuid
 			self.assertEqual(r, cmduuid)
 
-			# that it gets published
+			# that it gets published, to an actuator picked by
+			# the command, not the image
 			oc2p.assert_called_once_with(cmduuid,
-			    '{"action": "create", "target": {"x-newcontext-com:aws": {"image": "foo"}}}')
+			    '{"action": "create", "target": {"x-newcontext-com:aws": {"image": "foo"}}}',
+			    key=cmduuid)
 
 			# and that it's in pending
 			self.assertIn(cmduuid, get_ec2())
@@ -320,6 +936,23 @@ class ProxyClassTest(unittest.TestCase):
 
 			#openc2_recv(msg)
 
+	@patch('requests.get')
+	def test_healthcheck(self, mockget):
+		mockget.return_value.status_code = 200
+
+		# That the health check of an actuator
+		for url in ('http://a/ec2', 'http://a/ec2/'):
+			mockget.reset_mock()
+			self.assertTrue(_healthcheck(url))
+
+			# is under its path, w/ or w/o a trailing /
+			mockget.assert_called_once_with('http://a/ec2/health',
+			    timeout=5)
+
+		# and that an error status is not healthy
+		mockget.return_value.status_code = 503
+		self.assertFalse(_healthcheck('http://a/ec2'))
+
 	@patch('uuid.uuid4')
 	@_selfpatch('openc2_publish')
 	def test_ec2funs(self, oc2p, uuid):
@@ -337,7 +970,7 @@ class ProxyClassTest(unittest.TestCase):
 				f = globals()['ec2%s' % il]
 				f(inst)
 
-				kwargs = {}
+				kwargs = dict(key=inst)
 				if il == 'query':
 					kwargs['meth'] = 'get'
 
@@ -371,6 +1004,9 @@ class ProxyClassTest(unittest.TestCase):
 			# That it's uuid is no longer pending
 			self.assertNotIn(cmduuid, ec2.pending())
 
+			# and that the version changed
+			self.assertGreater(ec2.version(), 0)
+
 			# and that the instance is present
 			self.assertIn(instid, ec2.ec2ids())
 
@@ -451,6 +1087,80 @@ class ProxyClassTest(unittest.TestCase):
 				# and has the status report
 				self.assertEqual(ec2.status(instid), curstatus)
 
+			# when the fleet is queried
+			ec2.ec2inventory()
+
+			# and it receives a response
+			resp = Response(status=200, results=NewContextAWS(
+			    inventory={ 'otherinst': 'running' }))
+			sresp = _seropenc2(resp)
+			ec2.process_msg(cmduuid, sresp)
+
+			# that each instance is present
+			self.assertEqual(ec2.status('otherinst'), 'running')
+
+			# when instances are reconciled
+			ec2.ec2reconcile({ 'otherinst': 'stopped',
+			    'newinst': 'running' }, 'imageid')
+
+			# and it receives a report
+			resp = Response(status=200, results=NewContextAWS(
+			    report={ 'otherinst': 'stopped',
+			    'newinst': 'created' }))
+			sresp = _seropenc2(resp)
+			ec2.process_msg(cmduuid, sresp)
+
+			# that the changed instances have the outcome
+			self.assertEqual(ec2.status('otherinst'), 'stopped')
+			self.assertEqual(ec2.status('newinst'), 'created')
+
+			# when selected instances are started
+			ec2.ec2selected(START, { 'quarantine': 'true' })
+
+			# and it receives a report
+			resp = Response(status=200, results=NewContextAWS(
+			    report={ 'otherinst': 'started' }))
+			sresp = _seropenc2(resp)
+			ec2.process_msg(cmduuid, sresp)
+
+			# that the instances have the outcome
+			self.assertEqual(ec2.status('otherinst'), 'started')
+
+			# when an instance is started and waited on
+			ec2.ec2start(instid, wait='running')
+
+			# and it receives a processing response
+			curstatus = 'pending'
+			resp = Response(status=102, status_text=curstatus)
+			sresp = _seropenc2(resp)
+			ec2.process_msg(cmduuid, sresp)
+
+			# that it has the current state
+			self.assertEqual(ec2.status(instid), curstatus)
+
+			# when the fleet is queried
+			ec2.ec2inventory()
+
+			# and it receives an invalid response
+			with self.assertLogs(app.logger, 'ERROR'):
+				ec2.process_msg(cmduuid, '{"status": 200, '
+				    '"results": {"x-newcontext-com:aws": '
+				    '{"inventory": {}}}}')
+
+			# that it is no longer pending
+			self.assertNotIn(cmduuid, ec2.pending())
+
+			# when an instance is queried
+			ec2.ec2query(instid)
+
+			# and it receives an invalid response
+			with self.assertLogs(app.logger, 'ERROR'):
+				ec2.process_msg(cmduuid, '{"status": "bogus"}')
+
+			# that the instance says so
+			self.assertEqual(ec2.status(instid), 'invalid response')
+			self.assertNotIn(cmduuid, ec2.pending())
+
 			# that for each instance command
 			for i in _instcmds:
 				il = i.lower()
@@ -0,0 +1,179 @@
+'''Spread commands over multiple actuators.
+
+Commands are mapped to actuators w/ a consistent hash of a key (the
+instance name), so commands for an instance keep going to the same
+actuator, whose caches for it are warm, and adding or removing an
+actuator only moves the keys of that actuator.'''
+
+import bisect
+import hashlib
+import threading
+import time
+import unittest
+
+def _hash(key):
+	return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8],
+	    'big')
+
+class HashRing(object):
+	def __init__(self, nodes=(), replicas=100):
+		'''replicas is the number of points each node has on the
+		ring, more points spread the keys more evenly.'''
+
+		self._replicas = replicas
+		self._points = []
+		self._nodes = []
+
+		for i in nodes:
+			self.add(i)
+
+	def add(self, node):
+		for i in range(self._replicas):
+			bisect.insort(self._points,
+			    (_hash('%s#%d' % (node, i)), node))
+
+		self._nodes.append(node)
+
+	def remove(self, node):
+		self._points = [ x for x in self._points if x[1] != node ]
+		self._nodes.remove(node)
+
+	def nodes(self):
+		return tuple(self._nodes)
+
+	def get(self, key):
+		'''Return the node for key.'''
+
+		return next(self.iternodes(key))
+
+	def iternodes(self, key):
+		'''Return the nodes in the order they are used for key, the
+		first is the one it maps to, and the rest are the ones to
+		fail over to.'''
+
+		if not self._points:
+			return
+
+		idx = bisect.bisect(self._points, (_hash(key),))
+		seen = set()
+		for i in range(len(self._points)):
+			node = self._points[(idx + i) % len(self._points)][1]
+			if node not in seen:
+				seen.add(node)
+				yield node
+
+				if len(seen) == len(self._nodes):
+					return
+
+class ActuatorPool(object):
+	'''A HashRing of actuators that skips the ones that are down.
+
+	An actuator is marked down when a request to it fails, and is
+	marked up again when checkfun(actuator) returns True.  The start
+	method starts a thread to call check periodically.'''
+
+	def __init__(self, actuators, checkfun):
+		self._ring = HashRing(actuators)
+		self._checkfun = checkfun
+		self._lock = threading.Lock()
+		self._down = set()
+		self._thread = None
+
+	def candidates(self, key):
+		'''Return the actuators to try for key, in order.  The down
+		actuators are included last, in case they have come back.'''
+
+		nodes = list(self._ring.iternodes(key or ''))
+		with self._lock:
+			down = self._down.copy()
+
+		return [ x for x in nodes if x not in down ] + \
+		    [ x for x in nodes if x in down ]
+
+	def markdown(self, actuator):
+		with self._lock:
+			self._down.add(actuator)
+
+	def isdown(self, actuator):
+		return actuator in self._down
+
+	def check(self):
+		'''Check the health of each actuator.'''
+
+		for i in self._ring.nodes():
+			try:
+				ok = self._checkfun(i)
+			except Exception:
+				ok = False
+
+			with self._lock:
+				if ok:
+					self._down.discard(i)
+				else:
+					self._down.add(i)
+
+	def start(self, interval):
+		def run():
+			while True:
+				self.check()
+				time.sleep(interval)
+
+		self._thread = threading.Thread(target=run,
+		    name='actuatorcheck', daemon=True)
+		self._thread.start()
+
+class HashRingTest(unittest.TestCase):
+	def test_ring(self):
+		nodes = [ 'a', 'b', 'c', 'd' ]
+		hr = HashRing(nodes)
+		keys = [ 'openc2test-%d' % i for i in range(4000) ]
+
+		# That the keys are spread about evenly
+		counts = { x: 0 for x in nodes }
+		for i in keys:
+			counts[hr.get(i)] += 1
+		for i in nodes:
+			self.assertGreater(counts[i], 600)
+
+		# That the fail over order contains each node once
+		self.assertEqual(sorted(hr.iternodes('foo')), nodes)
+
+		# That when a node is removed
+		before = { x: hr.get(x) for x in keys }
+		hr.remove('b')
+
+		# only the keys of that node move
+		for i in keys:
+			if before[i] != 'b':
+				self.assertEqual(hr.get(i), before[i])
+			else:
+				self.assertNotEqual(hr.get(i), 'b')
+
+		# and an empty ring has no nodes
+		self.assertEqual(list(HashRing().iternodes('foo')), [])
+
+	def test_pool(self):
+		health = { 'a': True, 'b': True }
+		ap = ActuatorPool([ 'a', 'b' ], health.__getitem__)
+
+		first, second = ap.candidates('foo')
+
+		# That when the first actuator is marked down
+		ap.markdown(first)
+
+		# that it is tried last
+		self.assertEqual(ap.candidates('foo'), [ second, first ])
+
+		# and that when the health check passes
+		ap.check()
+
+		# that it is used again
+		self.assertEqual(ap.candidates('foo'), [ first, second ])
+
+		# That when the health check fails
+		health[second] = False
+		ap.check()
+
+		# that it is marked down
+		self.assertTrue(ap.isdown(second))
+		self.assertEqual(ap.candidates('foo'), [ first, second ])
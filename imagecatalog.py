@@ -0,0 +1,195 @@
+'''Resolving image names to images.
+
+Creating an instance needs the provider's image.  An ImageCatalog lists
+the images once, and resolves names (or ids) to them locally until the
+listing is ttl seconds old, so an unknown image is rejected w/o asking
+the provider, and repeated creates do not look up the image again.
+
+Where listing every usable image is too much, e.g. the public AMIs of
+EC2, only some are listed, and the others looked up one at a time, w/
+a lookup function like ec2lookup, and kept.'''
+
+from libcloud.compute.base import NodeImage
+from mock import MagicMock
+
+import threading
+import time
+import unittest
+
+def ec2lookup(drv, image):
+	'''Return the EC2 image w/ the id image, or None.'''
+
+	if not image.startswith('ami-'):
+		return None
+
+	try:
+		images = drv.list_images(ex_image_ids=[ image ])
+	except Exception:
+		# e.g. InvalidAMIID.NotFound
+		return None
+
+	return images[0] if images else None
+
+class ImageCatalog(object):
+	def __init__(self, ttl=600, missinterval=60, lookup=None, **listkwargs):
+		'''The images are listed w/ the driver's list_images(
+		**listkwargs) at most every ttl seconds, or when an image is
+		not found, at most every missinterval seconds.
+
+		When lookup is set, an image that is not listed is looked up
+		w/ lookup(driver, image), which returns the NodeImage or
+		None.  The images found are kept until the next listing
+		for the ttl, and the ones not found until the next listing,
+		or for missinterval seconds.'''
+
+		self._ttl = ttl
+		self._missinterval = missinterval
+		self._lookup = lookup
+		self._listkwargs = listkwargs
+		self._lock = threading.Lock()
+		self._images = {}
+		self._looked = {}
+		self._missing = {}	# image -> when the lookup missed
+		self._listed = None
+
+	def _list(self, drv, now):
+		images = {}
+		for i in drv.list_images(**self._listkwargs):
+			images[str(i.id)] = i
+			images[i.name] = i
+
+		self._images = images
+		self._missing = {}
+		self._listed = now
+
+	def resolve(self, drv, image):
+		'''Return the NodeImage w/ the name or id image, listing the
+		images of the driver drv if needed.  Raises ValueError if
+		there is no such image.'''
+
+		with self._lock:
+			now = time.monotonic()
+			if self._listed is None or now - self._listed >= self._ttl:
+				self._list(drv, now)
+				self._looked = {}
+			elif image not in self._images and image not in \
+			    self._looked and now - self._listed >= \
+			    self._missinterval:
+				# it may be a new image
+				self._list(drv, now)
+
+			try:
+				return self._images.get(image) or \
+				    self._looked[image]
+			except KeyError:
+				pass
+
+			missed = image in self._missing and now - \
+			    self._missing[image] < self._missinterval
+
+		img = None
+		if self._lookup and not missed:
+			img = self._lookup(drv, image)
+			if img is None:
+				with self._lock:
+					self._missing[image] = time.monotonic()
+
+		if img is None:
+			raise ValueError('unknown image: %s' % repr(image))
+
+		with self._lock:
+			self._looked[image] = img
+
+		return img
+
+class ImageCatalogTest(unittest.TestCase):
+	def test_resolve(self):
+		drv = MagicMock()
+		img = NodeImage(id='img-1', name='freebsd', driver=drv)
+		drv.list_images.return_value = [ img ]
+
+		ic = ImageCatalog(ttl=600, missinterval=600, ex_project='p')
+
+		# That an image is resolved by name
+		self.assertIs(ic.resolve(drv, 'freebsd'), img)
+
+		# and by id
+		self.assertIs(ic.resolve(drv, 'img-1'), img)
+
+		# and that the images were listed once
+		drv.list_images.assert_called_once_with(ex_project='p')
+
+		# That an unknown image is rejected
+		self.assertRaises(ValueError, ic.resolve, drv, 'bogus')
+
+		# w/o listing again
+		self.assertEqual(drv.list_images.call_count, 1)
+
+	def test_refresh(self):
+		drv = MagicMock()
+		img = NodeImage(id='img-1', name='freebsd', driver=drv)
+		drv.list_images.return_value = []
+
+		ic = ImageCatalog(ttl=600, missinterval=0)
+		self.assertRaises(ValueError, ic.resolve, drv, 'freebsd')
+
+		# That an image added later
+		drv.list_images.return_value = [ img ]
+
+		# is found when the images are listed again
+		self.assertIs(ic.resolve(drv, 'freebsd'), img)
+		self.assertEqual(drv.list_images.call_count, 2)
+
+		# That when the ttl passes
+		ic._ttl = 0
+		drv.list_images.return_value = []
+
+		# that the images are listed again
+		self.assertRaises(ValueError, ic.resolve, drv, 'freebsd')
+
+	def test_lookup(self):
+		drv = MagicMock()
+		img = NodeImage(id='ami-1', name='amazon', driver=drv)
+
+		def listimages(ex_image_ids=None, **kwargs):
+			if ex_image_ids is None:
+				return []
+			if ex_image_ids == [ 'ami-1' ]:
+				return [ img ]
+			raise Exception('InvalidAMIID.NotFound')
+
+		drv.list_images.side_effect = listimages
+
+		ic = ImageCatalog(ttl=600, missinterval=600, lookup=ec2lookup,
+		    ex_owner='self')
+
+		# That an image that is not listed is looked up by id
+		self.assertIs(ic.resolve(drv, 'ami-1'), img)
+		drv.list_images.assert_called_with(ex_image_ids=[ 'ami-1' ])
+
+		# and is kept
+		self.assertIs(ic.resolve(drv, 'ami-1'), img)
+		self.assertEqual(drv.list_images.call_count, 2)
+
+		# That an unknown id
+		self.assertRaises(ValueError, ic.resolve, drv, 'ami-2')
+
+		# and a name that is not an id are rejected
+		self.assertRaises(ValueError, ic.resolve, drv, 'bogus')
+		self.assertEqual(drv.list_images.call_count, 3)
+
+		# That the unknown id again
+		lookup = MagicMock(side_effect=ec2lookup)
+		ic._lookup = lookup
+		self.assertRaises(ValueError, ic.resolve, drv, 'ami-2')
+
+		# is rejected w/o asking the provider
+		lookup.assert_not_called()
+		self.assertEqual(drv.list_images.call_count, 3)
+
+		# That after the missinterval
+		ic._missinterval = 0
+
+		# that it is looked up again (after listing the images)
+		self.assertRaises(ValueError, ic.resolve, drv, 'ami-2')
+		lookup.assert_called_once_with(drv, 'ami-2')
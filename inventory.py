@@ -0,0 +1,574 @@
+'''Listing the fleet.
+
+The libcloud list_nodes methods return every node at once as full Node
+objects.  For commands that cover the whole fleet, iterinventory instead
+yields just the name, id and state of each node, a page of the
+provider's listing at a time where the provider supports it, and
+geninventory serializes them as they arrive.
+
+InventorySnapshot keeps a listing in a compact form, only creating a
+Node when one is needed.
+
+A selector, a dict of labels (tags on EC2) and their values, limits
+a listing to the nodes that have them all.  Where the provider can, it
+does the filtering, so the other nodes are never sent.
+
+getnode gets a single node w/ a request that only returns that node,
+where the provider supports it, so that its cost does not depend on the
+size of the fleet.  A node it does not find is missing; the fleet is
+never listed for it.'''
+
+from libcloud.compute.types import NodeState, Provider
+from mock import patch, MagicMock
+
+import array
+import bisect
+import collections.abc
+import json
+import re
+import unittest
+
+def _gceinstances(drv, params):
+	# Yield the instance objects of all the zones, w/ the listing
+	# parameters params.
+	conn = drv.connection
+	while True:
+		# the connection updates pageToken in params
+		conn.gce_params = params
+		resp = conn.request('/aggregated/instances', method='GET').object
+
+		for zone in resp.get('items', {}).values():
+			for i in zone.get('instances', []):
+				yield i
+
+		if 'pageToken' not in params:
+			return
+
+def _gceiterinventory(drv, selector=None, pagesize=500):
+	params = { 'maxResults': pagesize }
+	if selector:
+		params['filter'] = ' AND '.join('(labels.%s = %s)' % (k,
+		    json.dumps(v)) for k, v in sorted(selector.items()))
+
+	for i in _gceinstances(drv, params):
+		yield i['name'], str(i['id']), str(
+		    drv.NODE_STATE_MAP.get(i['status'], NodeState.UNKNOWN))
+
+def _gcegetnode(drv, name, nodeid=None):
+	# ex_get_node w/o a zone lists every instance to find the zone,
+	# instead the provider filters the listing on the name
+	for i in _gceinstances(drv, { 'filter': 'name = "%s"' % name }):
+		if i['name'] == name:
+			return drv._to_node(i)
+
+	raise KeyError(name)
+
+def _ec2iterinventory(drv, selector=None, pagesize=1000):
+	from libcloud.compute.drivers.ec2 import NAMESPACE
+	from libcloud.utils.xml import findall, findtext
+
+	params = { 'Action': 'DescribeInstances', 'MaxResults': pagesize }
+	if selector:
+		params.update(drv._build_filters({ 'tag:%s' % k: v for k, v in
+		    selector.items() }))
+	while True:
+		elem = drv.connection.request(drv.path, params=params).object
+
+		for rs in findall(element=elem, xpath='reservationSet/item',
+		    namespace=NAMESPACE):
+			for i in drv._to_nodes(rs, 'instancesSet/item'):
+				yield i.name, str(i.id), str(i.state)
+
+		token = findtext(element=elem, xpath='nextToken',
+		    namespace=NAMESPACE)
+		if not token:
+			return
+
+		params['NextToken'] = token
+
+# EC2 instance ids, the names of the instances w/o a Name tag
+_ec2idre = re.compile(r'^i-([0-9a-f]{8}|[0-9a-f]{17})$')
+
+def _ec2getnode(drv, name, nodeid=None):
+	if nodeid is None and _ec2idre.match(name):
+		nodeid = name
+
+	lookups = [ dict(ex_filters={ 'tag:Name': name }) ]
+	if nodeid is not None:
+		lookups.insert(0, dict(ex_node_ids=[ nodeid ]))
+
+	for kwargs in lookups:
+		try:
+			nodes = drv.list_nodes(**kwargs)
+		except Exception:
+			if 'ex_node_ids' not in kwargs:
+				raise
+
+			# e.g. no longer exists
+			continue
+
+		for i in nodes:
+			if i.name == name:
+				return i
+
+	# an untagged node is named by its id, so is found by it above
+	raise KeyError(name)
+
+# Provider: function(driver, selector) that yields (name, id, state) for
+# each node
+_iterinventory = {
+	Provider.GCE: _gceiterinventory,
+	Provider.EC2: _ec2iterinventory,
+}
+
+# Provider: function(driver, name, id) that returns the node name, w/ the
+# id when known, or raises KeyError
+_getnode = {
+	Provider.GCE: _gcegetnode,
+	Provider.EC2: _ec2getnode,
+}
+
+def _matches(node, selector):
+	labels = node.extra.get('labels') or node.extra.get('tags') or {}
+
+	return all(labels.get(k) == v for k, v in selector.items())
+
+def iterinventory(drv, selector=None):
+	'''Yield a tuple of name, id and state (as strs) for each node of
+	the driver drv, that matches selector when set.'''
+
+	try:
+		fun = _iterinventory[drv.type]
+	except KeyError:
+		return ((x.name, str(x.id), str(x.state)) for x in
+		    drv.list_nodes() if not selector or _matches(x, selector))
+
+	return fun(drv, selector)
+
+def iterstates(drv, selector=None):
+	'''Yield a tuple of name and state (as a str) for each node of the
+	driver drv, that matches selector when set.'''
+
+	return ((name, state) for name, nodeid, state in iterinventory(drv,
+	    selector))
+
+def getnode(drv, name, nodeid=None):
+	'''Return the Node named name, w/ the id nodeid if known, of the
+	driver drv.  Raises KeyError if there is no such node.'''
+
+	try:
+		fun = _getnode[drv.type]
+	except KeyError:
+		pass
+	else:
+		return fun(drv, name, nodeid)
+
+	for i in drv.list_nodes():
+		if i.name == name and (nodeid is None or str(i.id) == nodeid):
+			return i
+
+	raise KeyError(name)
+
+class _StrArray(object):
+	'''An immutable sequence of strs, stored as one bytes object.'''
+
+	__slots__ = ('_data', '_offs')
+
+	def __init__(self, strs):
+		data = bytearray()
+		offs = array.array('L', [ 0 ])
+		for i in strs:
+			data += i.encode('utf-8')
+			offs.append(len(data))
+
+		self._data = bytes(data)
+		self._offs = offs
+
+	def __len__(self):
+		return len(self._offs) - 1
+
+	def __getitem__(self, idx):
+		if not 0 <= idx < len(self):
+			raise IndexError(idx)
+
+		return self._data[self._offs[idx]:self._offs[idx +
+		    1]].decode('utf-8')
+
+	def nbytes(self):
+		return len(self._data) + self._offs.itemsize * len(self._offs)
+
+class InventorySnapshot(collections.abc.Mapping):
+	'''A read only mapping of instance name to state, that also knows
+	each instance's id.  The names, ids and states are kept in a few
+	flat arrays instead of as Node objects, and the node method makes
+	a Node only when an operation needs one.'''
+
+	__slots__ = ('_names', '_ids', '_states', '_statenames', '_drv')
+
+	def __init__(self, entries, drv=None):
+		'''entries is an iterable of (name, id, state) tuples, e.g.
+		from iterinventory, and drv the driver used to get the
+		nodes.'''
+
+		entries = sorted(entries)
+
+		statenames = []
+		stateidx = {}
+		states = array.array('H')
+		for name, nodeid, state in entries:
+			try:
+				states.append(stateidx[state])
+			except KeyError:
+				stateidx[state] = len(statenames)
+				states.append(len(statenames))
+				statenames.append(state)
+
+		self._names = _StrArray(x[0] for x in entries)
+		self._ids = _StrArray(x[1] for x in entries)
+		self._states = states
+		self._statenames = tuple(statenames)
+		self._drv = drv
+
+	@classmethod
+	def fromdriver(cls, drv):
+		return cls(iterinventory(drv), drv)
+
+	def withdriver(self, drv):
+		'''Return a snapshot sharing the entries of this one, that
+		gets the nodes w/ the driver drv.'''
+
+		res = object.__new__(type(self))
+		for i in self.__slots__:
+			setattr(res, i, getattr(self, i))
+		res._drv = drv
+
+		return res
+
+	def _find(self, name):
+		idx = bisect.bisect_left(self._names, name)
+		if idx == len(self._names) or self._names[idx] != name:
+			raise KeyError(name)
+
+		return idx
+
+	def __getitem__(self, name):
+		return self._statenames[self._states[self._find(name)]]
+
+	def __iter__(self):
+		return iter(self._names)
+
+	def __len__(self):
+		return len(self._names)
+
+	def nodeid(self, name):
+		return self._ids[self._find(name)]
+
+	def entries(self):
+		'''Yield the (name, id, state) tuples, sorted by name.'''
+
+		for i, name in enumerate(self._names):
+			yield name, self._ids[i], self._statenames[self._states[i]]
+
+	def node(self, name):
+		'''Return the Node of the instance name.'''
+
+		return getnode(self._drv, name, self.nodeid(name))
+
+	def nbytes(self):
+		'''Return the approximate memory used by the entries.'''
+
+		return self._names.nbytes() + self._ids.nbytes() + \
+		    self._states.itemsize * len(self._states)
+
+# The keys the OpenC2 (stix2) dictionaries accept
+_keyre = re.compile(r'^[A-Za-z0-9_-]{3,256}$')
+
+def iskey(name):
+	'''Return if name can be a key of a dictionary, like the inventory
+	or a selector, in an OpenC2 message.'''
+
+	return _keyre.match(name) is not None
+
+# The status text when instances are left out of a dictionary
+LEFTOUT = '%d instances w/ invalid names left out'
+
+def keyed(items):
+	'''Return a dict of the (name, value) tuples of items whose names
+	are keys (see iskey), and the number of the other ones.'''
+
+	res = {}
+	skipped = 0
+	for name, value in items:
+		if iskey(name):
+			res[name] = value
+		else:
+			skipped += 1
+
+	return res, skipped
+
+def geninventory(states, chunksize=64 * 1024):
+	'''Generate the JSON of a successful OpenC2 Response whose results
+	are the inventory of the (name, state) tuples of states.  The JSON
+	is yielded in strings of about chunksize characters.
+
+	The instances whose names are not keys (see iskey) are left out,
+	and counted in the status text.  If none are left, the response
+	is a 404, as an empty inventory is not valid.'''
+
+	chunk = []
+	size = 0
+	sep = ''
+	skipped = 0
+	for name, state in states:
+		if not iskey(name):
+			skipped += 1
+			continue
+
+		if not sep:
+			chunk.append('{"status": 200, "results": {"x-newcontext-com:aws": {"inventory": {')
+
+		s = '%s%s: %s' % (sep, json.dumps(name), json.dumps(state))
+		sep = ', '
+		chunk.append(s)
+		size += len(s)
+
+		if size >= chunksize:
+			yield ''.join(chunk)
+			chunk = []
+			size = 0
+
+	if not sep:
+		yield json.dumps(dict(status=404,
+		    status_text='no instances matched'))
+		return
+
+	chunk.append('}}}')
+	if skipped:
+		chunk.append(', "status_text": %s' % json.dumps(LEFTOUT %
+		    skipped))
+	chunk.append('}')
+	yield ''.join(chunk)
+
+class InventoryTest(unittest.TestCase):
+	def test_iterstates(self):
+		from libcloud.compute.drivers.dummy import DummyNodeDriver
+
+		dnd = DummyNodeDriver(2)
+
+		# That a driver w/o a paged listing lists all the nodes
+		self.assertEqual(list(iterstates(dnd)), [ (x.name, str(x.state))
+		    for x in dnd.list_nodes() ])
+
+	def test_gce(self):
+		from libcloud.compute.drivers.gce import GCENodeDriver
+
+		drv = MagicMock()
+		drv.type = Provider.GCE
+		drv.NODE_STATE_MAP = GCENodeDriver.NODE_STATE_MAP
+
+		pages = [
+			({ 'items': { 'zones/a': { 'instances': [
+			    { 'name': 'a', 'id': 1, 'status': 'RUNNING' } ] } } },
+			    'tok'),
+			({ 'items': { 'zones/b': { 'instances': [
+			    { 'name': 'b', 'id': 2, 'status': 'TERMINATED' } ] },
+			    'zones/c': {} } }, None),
+		]
+
+		def request(path, method):
+			obj, token = pages.pop(0)
+			if token:
+				drv.connection.gce_params['pageToken'] = token
+			else:
+				drv.connection.gce_params.pop('pageToken', None)
+
+			r = MagicMock()
+			r.object = obj
+			return r
+
+		drv.connection.request.side_effect = request
+
+		# That the nodes of each page are returned
+		self.assertEqual(list(iterinventory(drv)), [
+		    ('a', '1', 'running'), ('b', '2', 'stopped') ])
+
+		# That a selector is a filter on the labels
+		drv.connection.request.side_effect = None
+		drv.connection.request.return_value.object = {}
+		self.assertEqual(list(iterinventory(drv, { 'zone': 'b',
+		    'quarantine': 'true' })), [])
+		self.assertEqual(drv.connection.gce_params['filter'],
+		    '(labels.quarantine = "true") AND (labels.zone = "b")')
+
+	def test_selector(self):
+		from libcloud.compute.drivers.dummy import DummyNodeDriver
+
+		dnd = DummyNodeDriver(3)
+		nodes = dnd.list_nodes()
+		nodes[1].extra['labels'] = { 'quarantine': 'true' }
+
+		# That w/o a provider filter, the nodes are matched
+		self.assertEqual(list(iterstates(dnd, { 'quarantine': 'true' })),
+		    [ (nodes[1].name, str(nodes[1].state)) ])
+
+		drv = MagicMock()
+		drv.type = Provider.EC2
+		drv._build_filters.return_value = { 'Filter.1.Name': 'x' }
+		drv.connection.request.return_value.object = MagicMock()
+
+		# That on EC2 the selector is a tag filter
+		with patch('libcloud.utils.xml.findall') as fa, \
+		    patch('libcloud.utils.xml.findtext') as ft:
+			fa.return_value = []
+			ft.return_value = None
+			list(iterinventory(drv, { 'quarantine': 'true' }))
+
+		drv._build_filters.assert_called_once_with(
+		    { 'tag:quarantine': 'true' })
+		self.assertEqual(drv.connection.request.call_args[1]['params'][
+		    'Filter.1.Name'], 'x')
+
+	def test_getnode(self):
+		from libcloud.compute.drivers.dummy import DummyNodeDriver
+
+		drv = MagicMock()
+		drv.type = Provider.GCE
+
+		def request(path, method):
+			self.assertEqual(drv.connection.gce_params,
+			    { 'filter': 'name = "b"' })
+			r = MagicMock()
+			r.object = { 'items': { 'zones/a': { 'instances': [
+			    { 'name': 'b', 'id': 2, 'status': 'RUNNING' } ] } } }
+			return r
+
+		drv.connection.request.side_effect = request
+
+		# That a GCE node is fetched w/ a filter on its name
+		self.assertIs(getnode(drv, 'b'), drv._to_node.return_value)
+		drv._to_node.assert_called_once_with({ 'name': 'b', 'id': 2,
+		    'status': 'RUNNING' })
+		drv.connection.request.assert_called_once_with(
+		    '/aggregated/instances', method='GET')
+
+		node = MagicMock()
+		node.name = 'c'
+		drv = MagicMock()
+		drv.type = Provider.EC2
+		drv.list_nodes.return_value = [ node ]
+
+		# That an EC2 node is fetched by its id
+		self.assertIs(getnode(drv, 'c', 'i-1'), node)
+		drv.list_nodes.assert_called_with(ex_node_ids=[ 'i-1' ])
+
+		# or by its name tag
+		self.assertIs(getnode(drv, 'c'), node)
+		drv.list_nodes.assert_called_with(ex_filters={ 'tag:Name': 'c' })
+
+		# That an untagged node, named by its id
+		node.name = 'i-0123456789abcdef0'
+		drv.list_nodes.reset_mock()
+
+		# is fetched by its id
+		self.assertIs(getnode(drv, node.name), node)
+		drv.list_nodes.assert_called_once_with(
+		    ex_node_ids=[ node.name ])
+
+		# That when the filters find nothing
+		def listnodes(**kwargs):
+			return [] if kwargs else [ node ]
+
+		drv.list_nodes.side_effect = listnodes
+		drv.list_nodes.reset_mock()
+		node.name = 'c'
+
+		# that it raises KeyError
+		self.assertRaises(KeyError, getnode, drv, 'c')
+
+		# w/o listing the fleet
+		drv.list_nodes.assert_called_once_with(
+		    ex_filters={ 'tag:Name': 'c' })
+
+		# That other providers search the listing
+		dnd = DummyNodeDriver(2)
+		node = dnd.list_nodes()[1]
+		self.assertIs(getnode(dnd, node.name), node)
+		self.assertRaises(KeyError, getnode, dnd, 'bogus')
+
+	def test_snapshot(self):
+		from libcloud.compute.drivers.dummy import DummyNodeDriver
+
+		dnd = DummyNodeDriver(3)
+		nodes = dnd.list_nodes()
+		nodes[1].state = NodeState.STOPPED
+
+		snap = InventorySnapshot.fromdriver(dnd)
+
+		# That the snapshot maps names to states
+		self.assertEqual(snap, { x.name: str(x.state) for x in nodes })
+		self.assertEqual(len(snap), 3)
+		self.assertIn(nodes[1].name, snap)
+		self.assertNotIn('bogus', snap)
+		self.assertRaises(KeyError, snap.nodeid, 'bogus')
+
+		# and has the ids
+		self.assertEqual(snap.nodeid(nodes[2].name), str(nodes[2].id))
+		self.assertEqual(sorted(snap.entries()), sorted((x.name,
+		    str(x.id), str(x.state)) for x in nodes))
+
+		# and returns the node
+		self.assertIs(snap.node(nodes[2].name), nodes[2])
+
+		# That a snapshot w/ another driver
+		other = InventorySnapshot(snap.entries()).withdriver(dnd)
+
+		# has the same entries and returns the node
+		self.assertEqual(other, snap)
+		self.assertIs(other.node(nodes[2].name), nodes[2])
+
+		# That an empty snapshot is empty
+		self.assertEqual(InventorySnapshot([]), {})
+
+	def test_geninventory(self):
+		states = [ ('inst-%d' % i, 'running') for i in range(100) ]
+
+		# That the generated JSON
+		chunks = list(geninventory(iter(states), chunksize=100))
+
+		# is in multiple chunks
+		self.assertGreater(len(chunks), 2)
+
+		# and is a response w/ the inventory
+		self.assertEqual(json.loads(''.join(chunks)), {
+			'status': 200,
+			'results': { 'x-newcontext-com:aws': {
+				'inventory': dict(states) } },
+		})
+
+		# That an empty inventory is a 404
+		self.assertEqual(json.loads(''.join(geninventory([]))),
+		    { 'status': 404, 'status_text': 'no instances matched' })
+
+		# That names that are not keys
+		resp = json.loads(''.join(geninventory([ ('ab', 'running'),
+		    ('a.b.c', 'running'), ('abc', 'stopped') ])))
+
+		# are left out
+		self.assertEqual(resp['results']['x-newcontext-com:aws'][
+		    'inventory'], { 'abc': 'stopped' })
+
+		# and counted
+		self.assertEqual(resp['status_text'],
+		    '2 instances w/ invalid names left out')
+
+		# and that when none are left, it is a 404
+		self.assertEqual(json.loads(''.join(geninventory([
+		    ('a b', 'running') ])))['status'], 404)
+
+	def test_keyed(self):
+		# That only the names that are keys are kept
+		self.assertEqual(keyed([ ('abc', 1), ('a.b', 2), ('ab', 3),
+		    ('x_y-Z', 4) ]), ({ 'abc': 1, 'x_y-Z': 4 }, 2))
+
+		# and that an empty dict is not a key
+		self.assertFalse(iskey(''))
@@ -0,0 +1,311 @@
+'''Append only journal of the commands run by the backend.
+
+Each entry is a JSON line w/ the request id, HTTP method, command,
+response, start time and duration.  Entries are written by a single
+thread that commits them in groups: all the entries that arrive while
+the previous group is being fsync'd are written and fsync'd together,
+so at high rates each command pays for a fraction of an fsync.
+
+The journal is split into segments, and a new one is started when the
+current one reaches segsize bytes, or after a failed write.
+
+Usage:
+	python journal.py rebuild <dir>
+	python journal.py redrive <dir> <url> [--speed <n>]
+
+rebuild prints the state of an AWSOpenC2Proxy that has processed the
+journal, and redrive sends the commands to an actuator again, w/ the
+original spacing divided by speed (0 for as fast as possible).'''
+
+from mock import patch
+
+import argparse
+import glob
+import json
+import os
+import queue
+import tempfile
+import threading
+import time
+import unittest
+
+def segments(directory):
+	'''Return the paths of the segments in directory, oldest first.'''
+
+	return sorted(glob.glob(os.path.join(directory, 'journal-*.log')))
+
+class Journal(object):
+	def __init__(self, directory, segsize=64 * 1024 * 1024, maxbatch=1000,
+	    timeout=30):
+		'''An append waits at most timeout seconds for its entry to
+		be written.'''
+
+		self._dir = directory
+		self._segsize = segsize
+		self._maxbatch = maxbatch
+		self._timeout = timeout
+		self._queue = queue.Queue()
+
+		os.makedirs(directory, exist_ok=True)
+
+		# always start a new segment, the last one may end in a
+		# partial entry if we crashed
+		segs = segments(directory)
+		if segs:
+			self._segnum = int(segs[-1][-12:-4]) + 1
+		else:
+			self._segnum = 1
+		self._fp = None
+		self._open()
+
+		self._thread = threading.Thread(target=self._run,
+		    name='journal', daemon=True)
+		self._thread.start()
+
+	def _open(self):
+		if self._fp is not None:
+			self._fp.close()
+
+		self._fp = open(os.path.join(self._dir, 'journal-%08d.log' %
+		    self._segnum), 'ab')
+		self._segnum += 1
+
+	def append(self, entry, wait=True):
+		'''Add entry (a JSON serializable dict) to the journal.  If
+		wait is True, return once it has been fsync'd, and raise
+		OSError if it could not be written in time.'''
+
+		# event, error of the write
+		waiter = [ threading.Event(), None ] if wait else None
+		self._queue.put((json.dumps(entry).encode('utf-8') + b'\n',
+		    waiter))
+
+		if waiter is None:
+			return
+
+		if not waiter[0].wait(self._timeout):
+			raise OSError('journal write timed out')
+		if waiter[1] is not None:
+			raise OSError('journal write failed: %r' % waiter[1])
+
+	def close(self):
+		'''Write the queued entries, and stop.'''
+
+		self._queue.put(None)
+		self._thread.join()
+		self._fp.close()
+
+	def _run(self):
+		while True:
+			batch = [ self._queue.get() ]
+			while len(batch) < self._maxbatch:
+				try:
+					batch.append(self._queue.get_nowait())
+				except queue.Empty:
+					break
+
+			stop = None in batch
+			batch = [ x for x in batch if x is not None ]
+
+			err = None
+			try:
+				for line, waiter in batch:
+					self._fp.write(line)
+					if self._fp.tell() >= self._segsize:
+						self._fp.flush()
+						os.fsync(self._fp.fileno())
+						self._open()
+
+				self._fp.flush()
+				os.fsync(self._fp.fileno())
+			except Exception as e:
+				# e.g. a full disk, the waiters fail, and the
+				# next entries go to a new segment so they do
+				# not follow a partial one
+				err = e
+				try:
+					self._open()
+				except Exception:
+					pass
+
+			for line, waiter in batch:
+				if waiter is not None:
+					waiter[1] = err
+					waiter[0].set()
+
+			if stop:
+				return
+
+def replay(directory):
+	'''Return the entries of the journal in directory in the order
+	they were written.  A partially written entry at the end of a
+	segment is skipped.'''
+
+	for i in segments(directory):
+		with open(i, 'rb') as fp:
+			for line in fp:
+				if not line.endswith(b'\n'):
+					break
+
+				yield json.loads(line)
+
+def rebuild(directory, proxy=None):
+	'''Return proxy (by default a new AWSOpenC2Proxy) after having
+	processed the commands in the journal.'''
+
+	from frontend import AWSOpenC2Proxy, _deseropenc2
+
+	if proxy is None:
+		proxy = AWSOpenC2Proxy()
+
+	for i in replay(directory):
+		proxy._pending[i['request_id']] = _deseropenc2(i['command'])
+		proxy.process_msg(i['request_id'], i['response'])
+
+	return proxy
+
+def redrive(directory, url, speed=1):
+	'''Send the commands in the journal to the actuator at url.
+	Returns a list of the HTTP status codes.'''
+
+	import requests
+
+	res = []
+	prev = None
+	for i in replay(directory):
+		if speed and prev is not None:
+			time.sleep(max(0, i['time'] - prev) / speed)
+		prev = i['time']
+
+		r = requests.request(i['method'], url, data=i['command'],
+		    headers={ 'X-Request-ID': i['request_id'] })
+		res.append(r.status_code)
+
+	return res
+
+def main():
+	parser = argparse.ArgumentParser(description='OpenC2 command journal')
+	sub = parser.add_subparsers(dest='cmd', required=True)
+	p = sub.add_parser('rebuild')
+	p.add_argument('dir')
+	p = sub.add_parser('redrive')
+	p.add_argument('dir')
+	p.add_argument('url')
+	p.add_argument('--speed', type=float, default=1)
+
+	args = parser.parse_args()
+	if args.cmd == 'rebuild':
+		for k, v in sorted(rebuild(args.dir).ec2ids().items()):
+			print('%s\t%s' % (k, v))
+	else:
+		res = redrive(args.dir, args.url, args.speed)
+		print('%d commands, %d failed' % (len(res),
+		    len([ x for x in res if x // 100 != 2 ])))
+
+class JournalTest(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.TemporaryDirectory()
+		self.dir = self.tmpdir.name
+
+	def tearDown(self):
+		self.tmpdir.cleanup()
+
+	def test_journal(self):
+		j = Journal(self.dir)
+
+		# That appended entries
+		j.append({ 'a': 1 })
+		j.append({ 'a': 2 }, wait=False)
+		j.close()
+
+		# are replayed in order
+		self.assertEqual(list(replay(self.dir)), [ { 'a': 1 }, { 'a': 2 } ])
+
+		# That when a journal is reopened
+		j = Journal(self.dir)
+		j.append({ 'a': 3 })
+		j.close()
+
+		# it starts a new segment
+		self.assertEqual(len(segments(self.dir)), 2)
+		self.assertEqual(len(list(replay(self.dir))), 3)
+
+		# That a partial entry at the end of a segment
+		with open(segments(self.dir)[-1], 'ab') as fp:
+			fp.write(b'{"a": ')
+
+		# is skipped
+		self.assertEqual(len(list(replay(self.dir))), 3)
+
+	def test_rotation(self):
+		# That when the segment size is reached
+		j = Journal(self.dir, segsize=40)
+		for i in range(20):
+			j.append({ 'a': i }, wait=False)
+		j.close()
+
+		# that there are multiple segments
+		self.assertGreater(len(segments(self.dir)), 2)
+
+		# and nothing is lost
+		self.assertEqual([ x['a'] for x in replay(self.dir) ],
+		    list(range(20)))
+
+	def test_groupcommit(self):
+		j = Journal(self.dir)
+
+		with patch('os.fsync', wraps=os.fsync) as fsync:
+			# That when many threads append at once
+			threads = [ threading.Thread(target=j.append,
+			    args=({ 'a': i },)) for i in range(100) ]
+			for t in threads:
+				t.start()
+			for t in threads:
+				t.join()
+
+			# that they share fsyncs
+			self.assertLess(fsync.call_count, 100)
+
+		j.close()
+		self.assertEqual(len(list(replay(self.dir))), 100)
+
+	def test_writefailure(self):
+		j = Journal(self.dir, timeout=5)
+
+		# That when a write fails
+		with patch('os.fsync') as fsync:
+			fsync.side_effect = OSError(28, 'No space left on device')
+
+			# that the append fails
+			self.assertRaises(OSError, j.append, { 'a': 1 })
+
+		# and that the journal keeps working
+		j.append({ 'a': 2 })
+		j.close()
+		self.assertIn({ 'a': 2 }, list(replay(self.dir)))
+
+		# That when the writer is gone
+		j = Journal(self.dir, timeout=.1)
+		j.close()
+
+		# that an append times out
+		self.assertRaises(OSError, j.append, { 'a': 3 })
+
+	def test_rebuild(self):
+		from frontend import Command, Response, NewContextAWS
+		from frontend import CREATE, _seropenc2
+
+		j = Journal(self.dir)
+		j.append(dict(request_id='a', method='POST', time=0, duration=0,
+		    command=_seropenc2(Command(action=CREATE,
+		    target=NewContextAWS(image='img'))),
+		    response=_seropenc2(Response(status=200,
+		    results=NewContextAWS(instance='inst')))))
+		j.close()
+
+		# That the rebuilt proxy has the instance
+		self.assertEqual(rebuild(self.dir).ec2ids(),
+		    { 'inst': 'marked create' })
+
+if __name__ == '__main__':
+	main()
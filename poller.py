@@ -0,0 +1,217 @@
+'''Wait for instances to reach a state.
+
+Instead of each waiting command polling the cloud provider on its own,
+a single StatePoller thread lists the fleet once per interval, and only
+wakes up the waiters whose instance changed state.  The thread runs only
+while there are waiters.
+
+An instance that is not listed is in the state ABSENT, so that a wait
+for a deleted instance ends.'''
+
+import threading
+import time
+import unittest
+
+ABSENT = 'deleted'
+
+class StatePoller(object):
+	def __init__(self, listfun, interval=2):
+		'''listfun is called w/o arguments and returns a mapping of
+		instance name to state.  It is called at most once per
+		interval seconds.'''
+
+		self._listfun = listfun
+		self._interval = interval
+		self._lock = threading.Lock()
+		self._conds = {}	# name -> [ Condition, waiter count ]
+		self._fresh = {}	# name -> listings started before its wait
+		self._states = {}
+		self._started = 0	# listings started
+		self._gen = 0		# the last listing done
+		self._thread = None
+
+	def wait(self, name, state, deadline):
+		'''Wait until the instance name is in state, or until deadline
+		(in time.monotonic() time) passes.  Returns the last state
+		seen (ABSENT if the instance was not listed), or None if no
+		listing was done in time.
+
+		Only listings started after the call are considered, so a
+		stale state from before a command is never returned, even from
+		a listing that was running when wait was called.'''
+
+		with self._lock:
+			try:
+				condent = self._conds[name]
+			except KeyError:
+				condent = [ threading.Condition(self._lock), 0 ]
+				self._conds[name] = condent
+
+			condent[1] += 1
+			# _gen is the number, in the order started, of the
+			# last listing done, so one running now is not > startgen
+			startgen = self._started
+			self._fresh[name] = max(self._fresh.get(name, 0),
+			    startgen)
+
+			if self._thread is None:
+				self._thread = threading.Thread(target=self._run,
+				    name='statepoller', daemon=True)
+				self._thread.start()
+
+			try:
+				while True:
+					cur = self._states.get(name, ABSENT)
+					if self._gen > startgen and cur == state:
+						return cur
+
+					remaining = deadline - time.monotonic()
+					if remaining <= 0:
+						return cur if self._gen > startgen else None
+
+					condent[0].wait(remaining)
+			finally:
+				condent[1] -= 1
+				if not condent[1]:
+					del self._conds[name]
+
+	def _run(self):
+		while True:
+			with self._lock:
+				self._started += 1
+				gen = self._started
+
+			try:
+				states = self._listfun()
+			except Exception:
+				# keep the previous states, try again next interval
+				states = None
+
+			with self._lock:
+				if states is not None:
+					# only the instances waited on
+					# need to be compared
+					for i, condent in self._conds.items():
+						if self._fresh.get(i, gen) < gen or \
+						    states.get(i) != self._states.get(i):
+							condent[0].notify_all()
+
+					self._fresh = { k: v for k, v in
+					    self._fresh.items() if v >= gen }
+					self._states = states
+					self._gen = gen
+
+				if not self._conds:
+					self._thread = None
+					return
+
+			time.sleep(self._interval)
+
+class StatePollerTest(unittest.TestCase):
+	def setUp(self):
+		self.states = { 'a': 'stopped', 'b': 'running' }
+		self.calls = 0
+
+	def listfun(self):
+		self.calls += 1
+		return dict(self.states)
+
+	def test_wait(self):
+		sp = StatePoller(self.listfun, interval=.01)
+
+		# That when an instance is already in the state
+		# that it returns it
+		self.assertEqual(sp.wait('b', 'running',
+		    time.monotonic() + 5), 'running')
+
+		# That when the instance changes state while waiting
+		t = threading.Timer(.05, self.states.__setitem__,
+		    ('a', 'running'))
+		t.start()
+
+		# that it returns the new state
+		self.assertEqual(sp.wait('a', 'running',
+		    time.monotonic() + 5), 'running')
+		t.join()
+
+		# That when the deadline passes
+		# that it returns the current state
+		self.assertEqual(sp.wait('a', 'stopped',
+		    time.monotonic() + .05), 'running')
+
+		# and an unknown instance is absent
+		self.assertEqual(sp.wait('c', 'running',
+		    time.monotonic() + .05), ABSENT)
+
+		# That when an instance is deleted while waiting
+		t = threading.Timer(.05, self.states.pop, ('a', ))
+		t.start()
+
+		# that a wait for it to be deleted returns
+		self.assertEqual(sp.wait('a', 'deleted',
+		    time.monotonic() + 5), 'deleted')
+		t.join()
+
+		# That when no listing is done before the deadline
+		sp = StatePoller(lambda: time.sleep(.2) or {}, interval=.01)
+
+		# that it returns None
+		self.assertIsNone(sp.wait('a', 'running',
+		    time.monotonic() + .05))
+
+	def test_shared(self):
+		sp = StatePoller(self.listfun, interval=.05)
+
+		res = []
+		def waiter():
+			res.append(sp.wait('a', 'running', time.monotonic() + 5))
+
+		threads = [ threading.Thread(target=waiter) for x in range(10) ]
+		for t in threads:
+			t.start()
+
+		time.sleep(.2)
+		calls = self.calls
+		self.states['a'] = 'running'
+
+		for t in threads:
+			t.join()
+
+		# That all the waiters see the state
+		self.assertEqual(res, [ 'running' ] * 10)
+
+		# and that the listing was shared between them
+		self.assertLess(calls, 10)
+
+		# and that the thread stops when no one is waiting
+		time.sleep(.2)
+		self.assertIsNone(sp._thread)
+
+	def test_inflight(self):
+		started = threading.Event()
+		release = threading.Event()
+
+		def listfun():
+			if not started.is_set():
+				started.set()
+				release.wait()
+				# listed before the change
+				return { 'a': 'stopped' }
+
+			return dict(self.states)
+
+		sp = StatePoller(listfun, interval=.01)
+
+		t = threading.Thread(target=sp.wait, args=('b', 'running',
+		    time.monotonic() + 5))
+		t.start()
+		started.wait()
+
+		# That when a listing is running when wait is called
+		self.states['a'] = 'running'
+		threading.Timer(.05, release.set).start()
+
+		# that its stale state is not returned
+		self.assertEqual(sp.wait('a', 'stopped',
+		    time.monotonic() + .5), 'running')
+		t.join()
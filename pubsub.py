@@ -0,0 +1,184 @@
+'''Publish/subscribe transport for OpenC2 messages.
+
+This follows the topic layout of the OpenC2 MQTT transport work:
+commands are published to oc2/cmd/ap/<profile> (every actuator of that
+profile) or oc2/cmd/device/<id> (one actuator), and responses to
+oc2/rsp.  Since there is no HTTP request to carry the X-Request-ID
+header, messages are wrapped in an envelope that carries it, and the
+responses are correlated w/ the commands by it.
+
+LocalBroker is an in process stand in for the broker, useful for
+testing, and MQTTBroker connects to a real one w/ paho-mqtt.'''
+
+import base64
+import json
+import queue
+import threading
+import unittest
+
+CMDTOPIC = 'oc2/cmd/ap/x-newcontext-com:aws'
+RSPTOPIC = 'oc2/rsp'
+
+def devicetopic(devid):
+	return 'oc2/cmd/device/%s' % devid
+
+def topicmatch(filt, topic):
+	'''Return True if topic matches the MQTT topic filter filt, which
+	may contain + and # wildcards.'''
+
+	fparts = filt.split('/')
+	tparts = topic.split('/')
+	for i, f in enumerate(fparts):
+		if f == '#':
+			return True
+		if i >= len(tparts) or (f != '+' and f != tparts[i]):
+			return False
+
+	return len(fparts) == len(tparts)
+
+def mkenvelope(reqid, body, fmt='json', src=None):
+	'''Wrap the encoded OpenC2 message body (encoded in fmt).'''
+
+	headers = { 'request_id': reqid, 'content_type': fmt }
+	if src is not None:
+		headers['from'] = src
+
+	if fmt == 'json':
+		if isinstance(body, bytes):
+			body = body.decode('utf-8')
+	else:
+		body = base64.b64encode(body).decode('us-ascii')
+
+	return json.dumps({ 'headers': headers, 'body': body }).encode('utf-8')
+
+def parseenvelope(payload):
+	'''Return a tuple of the request id, body and format of an
+	envelope made by mkenvelope.'''
+
+	env = json.loads(payload)
+	headers = env['headers']
+	fmt = headers.get('content_type', 'json')
+
+	body = env['body']
+	if fmt != 'json':
+		body = base64.b64decode(body)
+
+	return headers['request_id'], body, fmt
+
+class LocalBroker(object):
+	'''In process broker.  Like a real broker, messages are delivered
+	by a separate thread, and never from within publish.'''
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._subs = []
+		self._queue = queue.Queue()
+		self._thread = threading.Thread(target=self._run,
+		    name='localbroker', daemon=True)
+		self._thread.start()
+
+	def subscribe(self, topic, callback):
+		'''Call callback(topic, payload) for every message published
+		to a topic matching the topic filter topic.'''
+
+		with self._lock:
+			self._subs.append((topic, callback))
+
+	def publish(self, topic, payload):
+		self._queue.put((topic, payload))
+
+	def join(self):
+		'''Wait until all the published messages, and the messages
+		published while handling them, have been delivered.'''
+
+		self._queue.join()
+
+	def _run(self):
+		while True:
+			topic, payload = self._queue.get()
+			try:
+				with self._lock:
+					subs = [ cb for filt, cb in self._subs if
+					    topicmatch(filt, topic) ]
+
+				for cb in subs:
+					try:
+						cb(topic, payload)
+					except Exception:
+						# a bad subscriber should not
+						# stop delivery to the others
+						pass
+			finally:
+				self._queue.task_done()
+
+class MQTTBroker(object):
+	'''Connection to an MQTT broker w/ the same interface as
+	LocalBroker.'''
+
+	def __init__(self, host, port=1883, qos=1):
+		import paho.mqtt.client as mqtt
+
+		if hasattr(mqtt, 'CallbackAPIVersion'):
+			self._client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+		else:	# pragma: no cover
+			self._client = mqtt.Client()
+
+		self._qos = qos
+		self._client.connect(host, port)
+		self._client.loop_start()
+
+	def subscribe(self, topic, callback):
+		self._client.message_callback_add(topic,
+		    lambda client, userdata, msg: callback(msg.topic, msg.payload))
+		self._client.subscribe(topic, qos=self._qos)
+
+	def publish(self, topic, payload):
+		self._client.publish(topic, payload, qos=self._qos)
+
+def parsebroker(spec):
+	'''Return an MQTTBroker for spec, which is host or host:port.'''
+
+	host, _, port = spec.partition(':')
+
+	return MQTTBroker(host, int(port or 1883))
+
+class PubSubTest(unittest.TestCase):
+	def test_topicmatch(self):
+		# That exact topics match
+		self.assertTrue(topicmatch(RSPTOPIC, 'oc2/rsp'))
+		self.assertFalse(topicmatch(RSPTOPIC, 'oc2/rsp/foo'))
+		self.assertFalse(topicmatch(RSPTOPIC, 'oc2'))
+
+		# and wildcards match
+		self.assertTrue(topicmatch('oc2/cmd/+/foo', 'oc2/cmd/device/foo'))
+		self.assertFalse(topicmatch('oc2/cmd/+/foo', 'oc2/cmd/device/bar'))
+		self.assertTrue(topicmatch('oc2/#', 'oc2/cmd/device/foo'))
+
+	def test_envelope(self):
+		# That a json message round trips
+		env = mkenvelope('reqid', '{"status": 200}', src='actuator')
+		self.assertEqual(parseenvelope(env),
+		    ('reqid', '{"status": 200}', 'json'))
+
+		# and so does a binary one
+		env = mkenvelope('reqid', b'\x00\xff', 'cbor')
+		self.assertEqual(parseenvelope(env), ('reqid', b'\x00\xff', 'cbor'))
+
+	def test_localbroker(self):
+		b = LocalBroker()
+		msgs = []
+
+		def reply(topic, payload):
+			msgs.append((topic, payload))
+			b.publish(RSPTOPIC, payload + b' reply')
+
+		b.subscribe('oc2/cmd/#', reply)
+		b.subscribe(RSPTOPIC, lambda t, p: msgs.append((t, p)))
+
+		# That a message to a subscribed topic
+		b.publish(devicetopic('one'), b'cmd')
+
+		# is delivered, as is the reply published while handling it
+		b.join()
+		self.assertEqual(msgs, [ ('oc2/cmd/device/one', b'cmd'),
+		    (RSPTOPIC, b'cmd reply') ])
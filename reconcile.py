@@ -0,0 +1,193 @@
+'''Drive instances to a desired state.
+
+Instead of a command per instance, each of which looks up its node,
+reconcile takes the desired state of many instances, compares them to
+one listing of the fleet, and runs only the operations needed, in
+parallel.  The result is a report of what was done to each instance.
+
+The desired states are running, stopped and deleted.'''
+
+from libcloud.compute.types import NodeState
+from mock import patch, MagicMock
+
+import concurrent.futures
+import threading
+import unittest
+
+from inventory import getnode, InventorySnapshot
+
+# state: states that need no operation to reach it
+_reached = {
+	'running': ('running', 'pending', 'starting', 'rebooting'),
+	'stopped': ('stopped', 'stopping', 'suspended'),
+	'deleted': ('terminated', ),
+}
+
+# operation: (driver method, outcome)
+_ops = {
+	'start': ('start_node', 'started'),
+	'stop': ('stop_node', 'stopped'),
+	'delete': ('destroy_node', 'deleted'),
+}
+
+def plan(inv, desired, create=True):
+	'''Return a dict of instance name to the list of operations
+	(create, start, stop or delete) that bring it from its state in
+	the mapping inv to the state in desired.  Instances that need
+	none are left out, and so are the ones that would need to be
+	created when create is False.  Raises ValueError for an unknown
+	state.'''
+
+	res = {}
+	for name, state in desired.items():
+		if state not in _reached:
+			raise ValueError('unknown state %s for %s' %
+			    (repr(state), repr(name)))
+
+		cur = inv.get(name, 'terminated')
+		if cur in _reached[state]:
+			continue
+
+		if state == 'deleted':
+			res[name] = [ 'delete' ]
+		elif cur == 'terminated':
+			if not create:
+				continue
+			res[name] = [ 'create' ] + ([ 'stop' ] if state ==
+			    'stopped' else [])
+		else:
+			res[name] = [ 'start' if state == 'running' else 'stop' ]
+
+	return res
+
+def reconcile(inv, desired, pool, create, workers=16):
+	'''Bring the instances to their states in desired, a dict of name
+	to state, from the InventorySnapshot inv.  The operations run on
+	up to workers threads, each w/ its own driver from pool (which
+	has get and put methods).  create is called w/ a driver and a name
+	to create an instance, when create is None nothing is created.
+
+	Returns a dict of name to the outcome: unchanged, not found (when
+	it would have to be created), the operations done (e.g. "created,
+	stopped") or the failure.'''
+
+	ops = plan(inv, desired, create is not None)
+	# not planned, but not there either, w/o create
+	report = { x: 'not found' if x not in ops and inv.get(x,
+	    'terminated') not in _reached[y] else 'unchanged' for x, y in
+	    desired.items() }
+
+	def run(name):
+		done = []
+		drv = pool.get()
+		try:
+			for op in ops[name]:
+				if op == 'create':
+					create(drv, name)
+					done.append('created')
+					continue
+
+				nodeid = inv.nodeid(name) if not done else None
+				meth, outcome = _ops[op]
+				if not getattr(drv, meth)(getnode(drv, name,
+				    nodeid)):
+					raise RuntimeError('unable to %s' % op)
+				done.append(outcome)
+		except Exception as e:
+			done.append('failed: %s' % repr(e))
+		finally:
+			pool.put(drv)
+
+		return ', '.join(done)
+
+	if ops:
+		with concurrent.futures.ThreadPoolExecutor(min(workers,
+		    len(ops))) as ex:
+			for name, outcome in zip(ops, ex.map(run, ops)):
+				report[name] = outcome
+
+	return report
+
+class ReconcileTest(unittest.TestCase):
+	def test_plan(self):
+		inv = { 'a': 'running', 'b': 'stopped', 'c': 'running',
+		    'd': 'terminated', 'e': 'pending' }
+
+		# That only the needed operations are planned
+		self.assertEqual(plan(inv, { 'b': 'running',
+		    'c': 'stopped', 'd': 'running', 'e': 'running',
+		    'f': 'stopped', 'g': 'deleted', 'a': 'deleted' }), {
+		    'a': [ 'delete' ], 'b': [ 'start' ], 'c': [ 'stop' ],
+		    'd': [ 'create' ], 'f': [ 'create', 'stop' ] })
+
+		# That w/o create, those that would be created are left out
+		self.assertEqual(plan(inv, { 'd': 'running', 'f': 'stopped',
+		    'b': 'running' }, create=False), { 'b': [ 'start' ] })
+
+		# and that an unknown state is rejected
+		self.assertRaises(ValueError, plan, inv, { 'a': 'bogus' })
+
+	def test_reconcile(self):
+		from libcloud.compute.drivers.dummy import DummyNodeDriver
+
+		class StartStopDriver(DummyNodeDriver):
+			def start_node(self, node):
+				node.state = NodeState.RUNNING
+				return True
+
+			def stop_node(self, node):
+				node.state = NodeState.STOPPED
+				return True
+
+		dnd = StartStopDriver(3)
+		nodes = list(dnd.list_nodes())
+		dnd.stop_node(nodes[1])
+		inv = InventorySnapshot.fromdriver(dnd)
+
+		pool = MagicMock()
+		pool.get.return_value = dnd
+
+		created = []
+		lock = threading.Lock()
+		def create(drv, name):
+			with lock:
+				created.append(name)
+
+		# That reconciling
+		report = reconcile(inv, { nodes[0].name: 'running',
+		    nodes[1].name: 'running', nodes[2].name: 'deleted',
+		    'new': 'running' }, pool, create)
+
+		# reports what was done
+		self.assertEqual(report, { nodes[0].name: 'unchanged',
+		    nodes[1].name: 'started', nodes[2].name: 'deleted',
+		    'new': 'created' })
+
+		# and did it
+		self.assertEqual(nodes[1].state, NodeState.RUNNING)
+		self.assertNotIn(nodes[2], dnd.list_nodes())
+		self.assertEqual(created, [ 'new' ])
+
+		# and returned the drivers
+		self.assertEqual(pool.get.call_count, pool.put.call_count)
+
+		# That a failure is reported
+		with patch.object(dnd, 'stop_node') as sn:
+			sn.return_value = False
+			report = reconcile(inv, { nodes[0].name: 'stopped' },
+			    pool, create)
+
+		self.assertEqual(report, { nodes[0].name:
+		    "failed: RuntimeError('unable to stop')" })
+
+		# That w/o create
+		dnd.destroy_node(nodes[0])
+		inv = { nodes[0].name: 'terminated', nodes[1].name: 'running' }
+		report = reconcile(inv, { nodes[0].name: 'running',
+		    nodes[1].name: 'running', 'absent': 'stopped',
+		    'gone': 'deleted' }, pool, None)
+
+		# that terminated and absent instances are not found
+		self.assertEqual(report, { nodes[0].name: 'not found',
+		    nodes[1].name: 'unchanged', 'absent': 'not found',
+		    'gone': 'unchanged' })
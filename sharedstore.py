@@ -0,0 +1,312 @@
+'''State that can be shared between multiple backend processes.
+
+The backend keeps a couple of pieces of state that must be consistent
+when it is run as multiple processes (e.g. gunicorn workers, or on
+multiple hosts w/ a shared file system): the instance name counter and
+the caches of cloud responses.  The SharedStore keeps these in a SQLite
+database, while the LocalStore provides the same interface for a single
+process.'''
+
+import itertools
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+
+class LocalStore(object):
+	'''Thread safe store for a single process.'''
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._counters = {}
+		self._cache = {}
+		self._built = {}	# key -> (expire, built value)
+
+	def nextval(self, counter):
+		'''Return the next value (starting at 1) of the named
+		counter.'''
+
+		with self._lock:
+			val = self._counters.get(counter, 0) + 1
+			self._counters[counter] = val
+
+		return val
+
+	def get(self, key):
+		'''Return the cached value for key, or None if it is missing
+		or has expired.'''
+
+		with self._lock:
+			try:
+				expire, value = self._cache[key]
+			except KeyError:
+				return None
+
+			if expire < time.time():
+				del self._cache[key]
+				return None
+
+		return value
+
+	def getbuilt(self, key, build):
+		'''Return build(value) for the cached value for key, or None
+		if it is missing or has expired.  build is only called once
+		for each value set.'''
+
+		with self._lock:
+			try:
+				expire, value = self._cache[key]
+			except KeyError:
+				return None
+
+			if expire < time.time():
+				del self._cache[key]
+				return None
+
+			built = self._built.get(key)
+			if built is not None and built[0] == expire:
+				return built[1]
+
+		obj = build(value)
+		with self._lock:
+			self._built[key] = (expire, obj)
+
+		return obj
+
+	def set(self, key, value, ttl):
+		'''Cache value under key for ttl seconds.'''
+
+		with self._lock:
+			self._cache[key] = (time.time() + ttl, value)
+			self._built.pop(key, None)
+
+	def invalidate(self, key):
+		with self._lock:
+			self._cache.pop(key, None)
+			self._built.pop(key, None)
+
+class SharedStore(object):
+	'''Store backed by a SQLite database, safe to use from multiple
+	threads and processes.  Cached values must be JSON serializable.'''
+
+	def __init__(self, path):
+		self._path = path
+		self._local = threading.local()
+		self._builtlock = threading.Lock()
+		self._built = {}	# key -> (expire, built value)
+
+		conn = self._conn()
+		conn.execute('CREATE TABLE IF NOT EXISTS counters '
+		    '(name TEXT PRIMARY KEY, value INTEGER NOT NULL)')
+		conn.execute('CREATE TABLE IF NOT EXISTS cache '
+		    '(key TEXT PRIMARY KEY, expire REAL NOT NULL, '
+		    'value TEXT NOT NULL)')
+
+	def _conn(self):
+		# sqlite3 connections can not be shared between threads
+		try:
+			return self._local.conn
+		except AttributeError:
+			pass
+
+		conn = sqlite3.connect(self._path, timeout=30,
+		    isolation_level=None)
+		conn.execute('PRAGMA journal_mode=WAL')
+		self._local.conn = conn
+
+		return conn
+
+	def nextval(self, counter):
+		'''Return the next value (starting at 1) of the named
+		counter.'''
+
+		conn = self._conn()
+
+		# IMMEDIATE takes the write lock up front, so no other
+		# process can read the same value.
+		conn.execute('BEGIN IMMEDIATE')
+		try:
+			conn.execute('INSERT OR IGNORE INTO counters '
+			    '(name, value) VALUES (?, 0)', (counter,))
+			conn.execute('UPDATE counters SET value = value + 1 '
+			    'WHERE name = ?', (counter,))
+			val, = conn.execute('SELECT value FROM counters '
+			    'WHERE name = ?', (counter,)).fetchone()
+		except:
+			conn.execute('ROLLBACK')
+			raise
+
+		conn.execute('COMMIT')
+
+		return val
+
+	def get(self, key):
+		'''Return the cached value for key, or None if it is missing
+		or has expired.'''
+
+		r = self._conn().execute('SELECT value FROM cache '
+		    'WHERE key = ? AND expire >= ?', (key, time.time())).fetchone()
+
+		if r is None:
+			return None
+
+		return json.loads(r[0])
+
+	def getbuilt(self, key, build):
+		'''Return build(value) for the cached value for key, or None
+		if it is missing or has expired.  build is only called once
+		in this process for each value set by any process.'''
+
+		# the expire time of a value identifies it, so a built one
+		# is reused w/o reading the value
+		conn = self._conn()
+		r = conn.execute('SELECT expire FROM cache '
+		    'WHERE key = ? AND expire >= ?', (key, time.time())).fetchone()
+
+		if r is None:
+			return None
+
+		with self._builtlock:
+			built = self._built.get(key)
+		if built is not None and built[0] == r[0]:
+			return built[1]
+
+		r = conn.execute('SELECT expire, value FROM cache '
+		    'WHERE key = ? AND expire >= ?', (key, time.time())).fetchone()
+
+		if r is None:
+			return None
+
+		obj = build(json.loads(r[1]))
+		with self._builtlock:
+			self._built[key] = (r[0], obj)
+
+		return obj
+
+	def set(self, key, value, ttl):
+		'''Cache value under key for ttl seconds.'''
+
+		self._conn().execute('INSERT OR REPLACE INTO cache '
+		    '(key, expire, value) VALUES (?, ?, ?)',
+		    (key, time.time() + ttl, json.dumps(value)))
+
+	def invalidate(self, key):
+		self._conn().execute('DELETE FROM cache WHERE key = ?', (key,))
+
+class NameIter(object):
+	'''An iterator of instance names that is safe to use from multiple
+	threads, and when store is a SharedStore, from multiple processes.'''
+
+	def __init__(self, store, fmt):
+		self._store = store
+		self._fmt = fmt
+
+	def __iter__(self):
+		return self
+
+	def __next__(self):
+		return self._fmt % self._store.nextval(self._fmt)
+
+class _StoreTests(object):
+	def test_nextval(self):
+		# That a new counter starts at one
+		self.assertEqual(self.store.nextval('a'), 1)
+		self.assertEqual(self.store.nextval('a'), 2)
+
+		# and that counters are independant
+		self.assertEqual(self.store.nextval('b'), 1)
+
+	def test_threads(self):
+		res = []
+
+		def allocate():
+			res.extend(self.store.nextval('a') for x in range(50))
+
+		threads = [ threading.Thread(target=allocate) for x in range(4) ]
+		for t in threads:
+			t.start()
+		for t in threads:
+			t.join()
+
+		# That no value is handed out twice
+		self.assertEqual(sorted(res), list(range(1, 201)))
+
+	def test_cache(self):
+		# That a missing key returns None
+		self.assertIsNone(self.store.get('inv'))
+
+		# That a set value is returned
+		self.store.set('inv', { 'a': 'running' }, 10)
+		self.assertEqual(self.store.get('inv'), { 'a': 'running' })
+
+		# and that once invalidated, it is gone
+		self.store.invalidate('inv')
+		self.assertIsNone(self.store.get('inv'))
+
+		# That an expired value is not returned
+		self.store.set('inv', { 'a': 'running' }, -1)
+		self.assertIsNone(self.store.get('inv'))
+
+	def test_getbuilt(self):
+		built = []
+		def build(value):
+			built.append(value)
+			return tuple(value)
+
+		# That a missing key returns None
+		self.assertIsNone(self.store.getbuilt('inv', build))
+
+		# That a value
+		self.store.set('inv', [ 1, 2 ], 10)
+
+		# is built
+		self.assertEqual(self.store.getbuilt('inv', build), (1, 2))
+
+		# once
+		self.assertEqual(self.store.getbuilt('inv', build), (1, 2))
+		self.assertEqual(built, [ [ 1, 2 ] ])
+
+		# That a new value is built again
+		self.store.set('inv', [ 3 ], 10)
+		self.assertEqual(self.store.getbuilt('inv', build), (3, ))
+		self.assertEqual(len(built), 2)
+
+		# and that once invalidated, it is gone
+		self.store.invalidate('inv')
+		self.assertIsNone(self.store.getbuilt('inv', build))
+
+	def test_nameiter(self):
+		ni = NameIter(self.store, 'openc2test-%d')
+
+		# That the names are generated in order
+		self.assertEqual(next(ni), 'openc2test-1')
+		self.assertEqual(list(itertools.islice(ni, 2)),
+		    [ 'openc2test-2', 'openc2test-3' ])
+
+class LocalStoreTest(_StoreTests, unittest.TestCase):
+	def setUp(self):
+		self.store = LocalStore()
+
+class SharedStoreTest(_StoreTests, unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.TemporaryDirectory()
+		self.path = os.path.join(self.tmpdir.name, 'store.sqlite')
+		self.store = SharedStore(self.path)
+
+	def tearDown(self):
+		self.tmpdir.cleanup()
+
+	def test_multiple(self):
+		# That when a second process opens the same store
+		other = SharedStore(self.path)
+
+		# that the counters are shared
+		self.assertEqual(self.store.nextval('a'), 1)
+		self.assertEqual(other.nextval('a'), 2)
+
+		# and so is the cache
+		self.store.set('inv', [ 1, 2 ], 10)
+		self.assertEqual(other.get('inv'), [ 1, 2 ])
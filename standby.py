@@ -0,0 +1,375 @@
+'''Instances kept ready to be claimed.
+
+Creating an instance takes the provider's whole provisioning time.  A
+StandbyPool creates instances of the configured images ahead of time,
+and stops them.  A create then claims one, and only has to start it.
+The pool is refilled in the background.
+
+The instances are labeled (tagged on EC2) w/ LABEL, ready while in the
+pool, and claimed once claimed, so they can be told apart from the
+others.  An instance that can not be stopped is deleted, and the
+refills back off after failures.
+
+The instances left ready when the process exits are deleted when the
+pool is next started, as their images are not known from a listing.
+So only one pool should fill from a fleet.'''
+
+from libcloud.compute.types import NodeState, Provider
+from mock import patch, MagicMock
+
+import threading
+import time
+import unittest
+
+from inventory import getnode, iterstates
+
+LABEL = 'openc2-standby'
+
+def _gcesetlabel(drv, node, value):
+	# the labels are replaced, keep the others
+	labels = dict(node.extra.get('labels') or {})
+	labels[LABEL] = value
+	drv.ex_set_node_labels(node, labels)
+
+def _ec2setlabel(drv, node, value):
+	drv.ex_create_tags(node, { LABEL: value })
+
+# Provider: function(driver, node, value) that sets the label LABEL of
+# the node to value
+_setlabel = {
+	Provider.GCE: _gcesetlabel,
+	Provider.EC2: _ec2setlabel,
+}
+
+def _label(drv, node, value):
+	try:
+		fun = _setlabel[drv.type]
+	except KeyError:
+		return
+
+	fun(drv, node, value)
+
+class StandbyPool(object):
+	def __init__(self, pool, create, names, images, size=2, interval=60):
+		'''Keep size stopped instances of each of images.  The
+		instances are named from the iterator names, and created w/
+		create(driver, image, name), w/ drivers from pool (which has
+		get and put methods).  The pool is checked every interval
+		seconds, and after each claim.'''
+
+		self._pool = pool
+		self._create = create
+		self._names = names
+		self._size = size
+		self._interval = interval
+		self._maxinterval = interval * 16
+		self._lock = threading.Lock()
+		self._wake = threading.Event()
+		self._thread = None
+
+		self._ready = { x: [] for x in images }
+		self._orphans = []	# created, but neither stopped nor deleted
+
+		self._hits = 0
+		self._misses = 0
+		self._claimtime = 0.
+		self._claimmax = 0.
+		self._lasterror = None
+
+	def claim(self, image):
+		'''Start a ready instance of image and return its name, or
+		return None if there are none.'''
+
+		start = time.monotonic()
+		with self._lock:
+			try:
+				name = self._ready[image].pop()
+			except (KeyError, IndexError):
+				name = None
+
+		if name is not None:
+			self._wake.set()
+
+			drv = self._pool.get()
+			try:
+				node = getnode(drv, name)
+				if not drv.start_node(node):
+					raise RuntimeError('unable to start')
+			except Exception as e:
+				self._lasterror = repr(e)
+
+				# do not keep it stopped, or leave it running
+				try:
+					self._delete(drv, name)
+				except Exception:
+					pass
+
+				name = None
+			else:
+				try:
+					_label(drv, node, 'claimed')
+				except Exception as e:
+					# it is claimed all the same
+					self._lasterror = repr(e)
+			finally:
+				self._pool.put(drv)
+
+		elapsed = time.monotonic() - start
+		with self._lock:
+			if name is None:
+				self._misses += 1
+			else:
+				self._hits += 1
+			self._claimtime += elapsed
+			self._claimmax = max(self._claimmax, elapsed)
+
+		return name
+
+	def _delete(self, drv, name):
+		try:
+			drv.destroy_node(getnode(drv, name))
+		except KeyError:
+			pass
+		except Exception:
+			with self._lock:
+				self._orphans.append(name)
+			raise
+
+	def fill(self):
+		'''Create and stop instances until each image has size.  An
+		instance that can not be stopped is deleted, and the failure
+		raised.'''
+
+		with self._lock:
+			orphans, self._orphans = self._orphans, []
+		for name in orphans:
+			drv = self._pool.get()
+			try:
+				self._delete(drv, name)
+			finally:
+				self._pool.put(drv)
+
+		for image, ready in self._ready.items():
+			while len(ready) < self._size:
+				drv = self._pool.get()
+				try:
+					name = next(self._names)
+					self._create(drv, image, name)
+					try:
+						node = getnode(drv, name)
+						_label(drv, node, 'ready')
+						if not drv.stop_node(node):
+							raise RuntimeError(
+							    'unable to stop %s' %
+							    repr(name))
+					except Exception:
+						# do not leave it running
+						self._delete(drv, name)
+						raise
+				finally:
+					self._pool.put(drv)
+
+				with self._lock:
+					ready.append(name)
+
+	def _leftovers(self):
+		'''Add the ready instances left by a previous process to the
+		ones to delete.'''
+
+		drv = self._pool.get()
+		try:
+			if drv.type not in _setlabel:
+				return
+
+			names = [ x for x, y in iterstates(drv,
+			    { LABEL: 'ready' }) ]
+		finally:
+			self._pool.put(drv)
+
+		with self._lock:
+			known = set(self._orphans).union(*self._ready.values())
+			self._orphans.extend(x for x in names if x not in known)
+
+	def start(self):
+		'''Fill the pool in the background, after deleting the
+		instances left by a previous process.'''
+
+		def run():
+			try:
+				self._leftovers()
+			except Exception as e:
+				self._lasterror = repr(e)
+
+			wait = self._interval
+			while True:
+				self._wake.clear()
+				try:
+					self.fill()
+				except Exception as e:
+					self._lasterror = repr(e)
+
+					# e.g. out of quota, the claims do not
+					# wake it up until the backoff is over
+					wait = min(wait * 2, self._maxinterval)
+					time.sleep(wait)
+					continue
+
+				self._lasterror = None
+				wait = self._interval
+				self._wake.wait(wait)
+
+		self._thread = threading.Thread(target=run, name='standby',
+		    daemon=True)
+		self._thread.start()
+
+	def stats(self):
+		'''Return a dict w/ the ready instances per image, the hits
+		and misses of the claims, and their mean and max seconds, and
+		the instances that could not be deleted.'''
+
+		with self._lock:
+			claims = self._hits + self._misses
+			return dict(ready={ k: len(v) for k, v in
+			    self._ready.items() }, orphans=len(self._orphans),
+			    hits=self._hits,
+			    misses=self._misses, hitrate=self._hits / claims if
+			    claims else None, claimmean=self._claimtime / claims
+			    if claims else None, claimmax=self._claimmax,
+			    error=self._lasterror)
+
+class StandbyPoolTest(unittest.TestCase):
+	def test_pool(self):
+		import itertools
+		from libcloud.compute.drivers.dummy import DummyNodeDriver
+		from libcloud.compute.base import Node
+
+		class Driver(DummyNodeDriver):
+			def start_node(self, node):
+				node.state = NodeState.RUNNING
+				return True
+
+			def stop_node(self, node):
+				node.state = NodeState.STOPPED
+				return True
+
+		dnd = Driver(0)
+		dnd.nl = []
+		pool = MagicMock()
+		pool.get.return_value = dnd
+
+		def create(drv, image, name):
+			drv.nl.append(Node(id=name, name=name,
+			    state=NodeState.RUNNING, public_ips=[],
+			    private_ips=[], driver=drv, extra={ 'image': image }))
+
+		sp = StandbyPool(pool, create, ('standby-%d' % i for i in
+		    itertools.count(1)), [ 'img' ], size=2)
+
+		# That a filled pool
+		sp.fill()
+
+		# has stopped instances of the image
+		self.assertEqual([ (x.extra['image'], x.state) for x in
+		    dnd.list_nodes() ], [ ('img', NodeState.STOPPED) ] * 2)
+		self.assertEqual(sp.stats()['ready'], { 'img': 2 })
+
+		# That a claim
+		name = sp.claim('img')
+
+		# starts one
+		node = getnode(dnd, name)
+		self.assertEqual(node.state, NodeState.RUNNING)
+
+		# and it is no longer ready
+		self.assertEqual(sp.stats()['ready'], { 'img': 1 })
+
+		# That an image w/o instances misses
+		self.assertIsNone(sp.claim('other'))
+
+		# and that the claims are counted
+		stats = sp.stats()
+		self.assertEqual((stats['hits'], stats['misses'],
+		    stats['hitrate']), (1, 1, .5))
+		self.assertGreaterEqual(stats['claimmax'], stats['claimmean'])
+
+		# That the pool is refilled
+		sp.fill()
+		self.assertEqual(sp.stats()['ready'], { 'img': 2 })
+		self.assertEqual(len(dnd.list_nodes()), 3)
+
+		# That when an instance can not be stopped
+		dnd.stop_node = lambda node: False
+		sp._size = 3
+
+		# that the fill fails
+		self.assertRaises(RuntimeError, sp.fill)
+
+		# and the instance is deleted
+		self.assertEqual(len(dnd.list_nodes()), 3)
+		self.assertEqual(sp.stats()['ready'], { 'img': 2 })
+		self.assertEqual(sp.stats()['orphans'], 0)
+
+		# That when a claimed instance can not be started
+		dnd.start_node = lambda node: False
+
+		# that the claim misses
+		self.assertIsNone(sp.claim('img'))
+
+		# and the instance is deleted
+		self.assertEqual(len(dnd.list_nodes()), 2)
+		self.assertEqual(sp.stats()['ready'], { 'img': 1 })
+
+		# That when it can not be deleted either
+		def destroy(node):
+			raise RuntimeError('provider down')
+		dnd.destroy_node = destroy
+		self.assertIsNone(sp.claim('img'))
+
+		# that it is kept to be deleted later
+		self.assertEqual(sp.stats()['orphans'], 1)
+
+	def test_leftovers(self):
+		drv = MagicMock()
+		drv.type = Provider.EC2
+		pool = MagicMock()
+		pool.get.return_value = drv
+
+		sp = StandbyPool(pool, None, iter(()), [ 'img' ])
+		sp._ready['img'].append('standby-1')
+
+		# That the ready instances of a previous process
+		with patch('standby.iterstates') as its:
+			its.return_value = iter([ ('standby-1', 'stopped'),
+			    ('standby-2', 'stopped') ])
+			sp._leftovers()
+
+		# are listed by their label
+		its.assert_called_once_with(drv, { LABEL: 'ready' })
+
+		# and are to be deleted, but not the pool's own
+		self.assertEqual(sp._orphans, [ 'standby-2' ])
+		self.assertEqual(sp.stats()['orphans'], 1)
+		pool.put.assert_called_once_with(drv)
+
+	def test_label(self):
+		drv = MagicMock()
+		drv.type = Provider.GCE
+		node = MagicMock()
+		node.extra = { 'labels': { 'env': 'prod' } }
+
+		# That a GCE label keeps the others
+		_label(drv, node, 'ready')
+		drv.ex_set_node_labels.assert_called_once_with(node,
+		    { 'env': 'prod', LABEL: 'ready' })
+
+		# That an EC2 tag is added
+		drv.type = Provider.EC2
+		_label(drv, node, 'claimed')
+		drv.ex_create_tags.assert_called_once_with(node,
+		    { LABEL: 'claimed' })
+
+		# That other providers are not labeled
+		drv = MagicMock()
+		drv.type = Provider.DUMMY
+		_label(drv, node, 'ready')
+		self.assertEqual(drv.method_calls, [])
@@ -1,6 +1,14 @@
 from html5validator.validator import Validator
+from concurrent.futures import ThreadPoolExecutor
+from mock import patch
+import atexit
+import hashlib
+import requests
+import socket
+import subprocess
+import threading
+import time
 import unittest
-import tempfile
 import logging
 
 _QUICK = False
@@ -14,21 +22,116 @@ class InvalidHTML(Exception):
 
 	pass
 
+class ValidatorService(object):
+	'''Keep one vnu validator running as a local HTTP service, instead
+	of starting java for each document.  Results are cached by the
+	hash of the document, so a page is only validated once.'''
+
+	def __init__(self, workers=4):
+		self._lock = threading.Lock()
+		self._proc = None
+		self._url = None
+		self._cache = {}
+		self._workers = workers
+
+	def _start(self):
+		with self._lock:
+			if self._proc is not None:
+				return
+
+			with socket.socket() as s:
+				s.bind(('127.0.0.1', 0))
+				port = s.getsockname()[1]
+
+			jar = Validator().vnu_jar_location
+			self._proc = subprocess.Popen([ 'java', '-cp', jar,
+			    'nu.validator.servlet.Main', str(port) ],
+			    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+			atexit.register(self.stop)
+
+			# wait for it to accept connections
+			for i in range(600):
+				try:
+					socket.create_connection(('127.0.0.1',
+					    port), timeout=1).close()
+					break
+				except OSError:
+					if self._proc.poll() is not None:
+						self._proc = None
+						raise RuntimeError(
+						    'validator failed to start')
+					time.sleep(.1)
+			else:
+				self._proc.terminate()
+				self._proc.wait()
+				self._proc = None
+				raise RuntimeError('validator did not accept '
+				    'connections')
+
+			self._url = 'http://127.0.0.1:%d/?out=json' % port
+
+	def stop(self):
+		with self._lock:
+			if self._proc is not None:
+				self._proc.terminate()
+				self._proc.wait()
+				self._proc = None
+
+	def _check(self, doc):
+		'''Return the text of the errors and warnings (like the
+		html5validator command, not the info messages) for doc.'''
+
+		self._start()
+
+		r = requests.post(self._url, data=doc,
+		    headers={ 'Content-Type': 'text/html; charset=utf-8' })
+		r.raise_for_status()
+
+		return [ x['message'] for x in r.json()['messages'] if
+		    x.get('type') in ('error', 'warning') or
+		    x.get('subType') == 'warning' ]
+
+	def validate(self, docs):
+		'''Return a list of the errors for each document in docs.
+		The documents not in the cache are validated in parallel.'''
+
+		docs = [ x.encode('utf-8') if isinstance(x, str) else x for x
+		    in docs ]
+		hashes = [ hashlib.sha256(x).hexdigest() for x in docs ]
+
+		with self._lock:
+			todo = { h: d for h, d in zip(hashes, docs) if h not in
+			    self._cache }
+		if todo:
+			# not under the lock, _check starts the validator w/ it
+			with ThreadPoolExecutor(self._workers) as ex:
+				res = list(ex.map(self._check, todo.values()))
+
+			with self._lock:
+				self._cache.update(zip(todo, res))
+
+		with self._lock:
+			return [ self._cache[x] for x in hashes ]
+
+_service = ValidatorService()
+
 def svalid(arg):
 	'''Validate the passing in string to be valid HTML.  Returns True
 	if the string is valid, otherwise raises the InvalidHTML exception.'''
 
-	if _QUICK:
-		return True
+	return svalidall([ arg ])
 
-	with tempfile.NamedTemporaryFile() as fp:
-		fp.write(arg)
-		fp.flush()
+def svalidall(args):
+	'''Validate the passed in strings to be valid HTML.  Returns True
+	if they all are, otherwise raises the InvalidHTML exception.'''
 
-		i = Validator().validate([ fp.name])
+	if _QUICK:
+		return True
 
-		if i:
-			raise InvalidHTML('%d errors' % i)
+	msgs = [ x for y in _service.validate(args) for x in y ]
+	if msgs:
+		raise InvalidHTML('%d errors: %s' % (len(msgs),
+		    '; '.join(msgs)))
 
 	return True
 
@@ -58,3 +161,73 @@ class SValidTest(unittest.TestCase):
 
 		# even invalid HTML returns True
 		self.assertTrue(svalid('<html><head>foo'))
+
+	def test_cache(self):
+		vs = ValidatorService()
+
+		with patch.object(vs, '_check') as check:
+			check.side_effect = lambda x: [] if x == b'good' else \
+			    [ 'a', 'b' ]
+
+			# That a batch of documents
+			res = vs.validate([ 'good', b'bad', 'good' ])
+
+			# returns the errors of each
+			self.assertEqual(res, [ [], [ 'a', 'b' ], [] ])
+
+			# and that each document was only checked once
+			self.assertEqual(check.call_count, 2)
+
+			# That when validated again
+			res = vs.validate([ b'bad' ])
+
+			# that the cached result is used
+			self.assertEqual(res, [ [ 'a', 'b' ] ])
+			self.assertEqual(check.call_count, 2)
+
+	def test_check(self):
+		vs = ValidatorService()
+		vs._url = 'http://localhost/'
+
+		msgs = [
+			{ 'type': 'error', 'message': 'bad tag' },
+			{ 'type': 'info', 'subType': 'warning',
+			    'message': 'odd tag' },
+			{ 'type': 'info', 'message': 'just so you know' },
+		]
+
+		with patch.object(vs, '_start'), \
+		    patch('requests.post') as post:
+			post.return_value.json.return_value = {
+			    'messages': msgs }
+
+			# That the info messages are not errors
+			self.assertEqual(vs._check(b'doc'),
+			    [ 'bad tag', 'odd tag' ])
+
+		# and that the failure has the messages
+		with patch.object(_service, 'validate') as validate:
+			global _QUICK
+			_QUICK = False
+			validate.return_value = [ [ 'bad tag', 'odd tag' ] ]
+			with self.assertRaisesRegex(InvalidHTML,
+			    '2 errors: bad tag; odd tag'):
+				svalid('doc')
+
+	@patch('time.sleep')
+	@patch('socket.create_connection')
+	@patch('subprocess.Popen')
+	@patch('svalid.Validator')
+	def test_nostart(self, val, popen, conn, sleep):
+		vs = ValidatorService()
+
+		# That when the validator never accepts connections
+		conn.side_effect = OSError()
+		popen.return_value.poll.return_value = None
+
+		# that it raises an error
+		self.assertRaises(RuntimeError, vs._start)
+
+		# and is not used
+		self.assertIsNone(vs._url)
+		popen.return_value.terminate.assert_called_once_with()